@@ -0,0 +1,105 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# the six levels of each channel in xterm's 6x6x6 color cube
+CUBE_LEVELS = np.array([0, 95, 135, 175, 215, 255], dtype=np.int32)
+
+# decimal strings for every channel value, so escapes are joined instead of formatted per cell
+NUMBERS = np.array(list(map(str, range(256))), dtype=object)
+
+UPPER_HALF = '▀'
+RESET = '\x1b[0m'
+
+def cellSize(size, columns, rows):
+    width, height = size
+
+    # a cell is about twice as tall as it is wide and shows two pixels stacked
+    scale = min(columns / width, 2 * rows / height)
+
+    return max(1, int(width * scale)), max(2, int(height * scale) // 2 * 2)
+
+def loadPixels(imgdata, columns, rows):
+    img = Image.open(io.BytesIO(imgdata))
+
+    size = cellSize(img.size, columns, rows)
+
+    # JPEGs can decode straight at a fraction of their size, which is most of the work
+    img.draft('RGB', size)
+    img = img.convert('RGB').resize(size, Image.BOX)
+
+    return np.asarray(img, dtype=np.int32)
+
+def to256(pixels):
+    # nearest color of the cube and of the grayscale ramp, whichever is closer
+    levels = np.abs(pixels[..., None] - CUBE_LEVELS).argmin(axis=-1)
+    cube = 16 + 36 * levels[..., 0] + 6 * levels[..., 1] + levels[..., 2]
+    cubeError = ((pixels - CUBE_LEVELS[levels]) ** 2).sum(axis=-1)
+
+    grays = np.clip(np.rint((pixels.mean(axis=-1) - 8) / 10), 0, 23).astype(np.int32)
+    grayError = ((pixels - (8 + 10 * grays)[..., None]) ** 2).sum(axis=-1)
+
+    return np.where(grayError < cubeError, 232 + grays, cube)
+
+def renderAnsi(imgdata, columns, rows, truecolor=True):
+    pixels = loadPixels(imgdata, columns, rows)
+
+    # the upper half block is drawn in the top pixel's color over the bottom one's
+    top = pixels[0::2]
+    bottom = pixels[1::2]
+
+    if truecolor:
+        escapes = ('\x1b[38;2;' + NUMBERS[top[..., 0]] + ';' + NUMBERS[top[..., 1]] + ';' + NUMBERS[top[..., 2]] +
+                   ';48;2;' + NUMBERS[bottom[..., 0]] + ';' + NUMBERS[bottom[..., 1]] + ';' + NUMBERS[bottom[..., 2]] + 'm')
+        colors = np.concatenate((top, bottom), axis=-1)
+    else:
+        fg = to256(top)
+        bg = to256(bottom)
+        escapes = '\x1b[38;5;' + NUMBERS[fg] + ';48;5;' + NUMBERS[bg] + 'm'
+        colors = np.stack((fg, bg), axis=-1)
+
+    # a cell the same colors as its left neighbour needs no escape of its own
+    repeated = np.zeros(escapes.shape, dtype=bool)
+    repeated[:, 1:] = (colors[:, 1:] == colors[:, :-1]).all(axis=-1)
+    escapes[repeated] = ''
+
+    return '\n'.join(map(lambda row: ''.join(row) + RESET, escapes + UPPER_HALF)) + '\n'
+
+def palette(imgdata, count=5, size=64):
+    img = Image.open(io.BytesIO(imgdata))
+    img.draft('RGB', (size, size))
+    pixels = np.asarray(img.convert('RGB').resize((size, size), Image.BOX), dtype=np.int64).reshape(-1, 3)
+
+    # 4 bits per channel, then the average of what fell in each of the biggest buckets
+    buckets = (pixels[:, 0] >> 4) << 8 | (pixels[:, 1] >> 4) << 4 | pixels[:, 2] >> 4
+    counts = np.bincount(buckets, minlength=4096)
+    sums = np.stack(list(map(lambda c: np.bincount(buckets, weights=pixels[:, c], minlength=4096), range(3))), axis=-1)
+
+    colors = []
+    for bucket in np.argsort(-counts, kind='stable'):
+        if counts[bucket] == 0 or len(colors) == count:
+            break
+
+        color = np.rint(sums[bucket] / counts[bucket]).astype(np.int64)
+
+        # neighbouring buckets of one color would otherwise fill the whole palette
+        if any(np.abs(color - c['rgb']).sum() < 48 for c in colors):
+            continue
+
+        colors.append({'rgb': color, 'share': counts[bucket] / len(buckets)})
+
+    return list(map(lambda c: {'hex': '#{:02x}{:02x}{:02x}'.format(*c['rgb']), 'rgb': c['rgb'].tolist(), 'share': round(float(c['share']), 3)}, colors))
+
+def renderPalette(imgdata, count=5, truecolor=True):
+    lines = []
+
+    for color in palette(imgdata, count=count):
+        if truecolor:
+            escape = '\x1b[48;2;{};{};{}m'.format(*color.get('rgb'))
+        else:
+            escape = '\x1b[48;5;{}m'.format(int(to256(np.array(color.get('rgb'), dtype=np.int32))))
+
+        lines.append('{}{}{} {} {:.0%}'.format(escape, ' ' * 8, RESET, color.get('hex'), color.get('share')))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,529 @@
+#!python3
+
+import argparse
+import base64
+import hashlib
+import math
+import random
+import re
+import string
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from flask import Flask, Response, jsonify, redirect, request
+
+BASE62 = string.digits + string.ascii_letters
+
+# a realistic share of the ~180 markets a track lists
+MARKETS = ['AD', 'AR', 'AT', 'AU', 'BE', 'BG', 'BO', 'BR', 'CA', 'CH', 'CL', 'CO', 'CR', 'CY', 'CZ', 'DE', 'DK', 'DO', 'EC', 'EE', 'ES', 'FI', 'FR', 'GB', 'GR', 'GT', 'HK', 'HN', 'HU', 'ID', 'IE', 'IL', 'IS', 'IT', 'JP', 'LI', 'LT', 'LU', 'LV', 'MC', 'MT', 'MX', 'MY', 'NI', 'NL', 'NO', 'NZ', 'PA', 'PE', 'PH', 'PL', 'PT', 'PY', 'RO', 'SE', 'SG', 'SK', 'SV', 'TH', 'TR', 'TW', 'US', 'UY', 'VN', 'ZA']
+
+def isoformat(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+class Fixtures:
+    def __init__(self, seed=0, playlists=120, tracks=2000, bigPlaylist=10000, recents=500):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.artists = list(map(lambda i: self._artist(i), range(max(tracks // 8, 1))))
+        self.albums = list(map(lambda i: self._album(i), range(max(tracks // 10, 1))))
+        self.tracks = list(map(lambda i: self._track(i), range(tracks)))
+        self.byUri = dict(map(lambda t: (t['uri'], t), self.tracks))
+
+        self.playlists = OrderedPlaylists()
+        for idx in range(playlists):
+            size = bigPlaylist if idx == 0 else self.rng.randint(0, 300)
+            self.playlists.add(self._playlist(idx, size))
+
+        self.devices = [
+            {'id': self._id(), 'is_active': True, 'is_private_session': False, 'is_restricted': False, 'name': 'Kitchen', 'type': 'Speaker', 'volume_percent': 40, 'supports_volume': True},
+            {'id': self._id(), 'is_active': False, 'is_private_session': False, 'is_restricted': False, 'name': 'Laptop', 'type': 'Computer', 'volume_percent': 80, 'supports_volume': True},
+            {'id': self._id(), 'is_active': False, 'is_private_session': False, 'is_restricted': False, 'name': 'Phone', 'type': 'Smartphone', 'volume_percent': 100, 'supports_volume': False}
+        ]
+
+        # plays end about three and a half minutes apart, the newest one just now
+        now = int(time.time() * 1000)
+        self.recents = list(map(lambda i: {'track': self.tracks[self.rng.randrange(len(self.tracks))], 'played_at': isoformat(now - i * 210000), 'played_at_ms': now - i * 210000,
+                                           'playlist': self.playlists.items[i % len(self.playlists.items)]}, range(recents)))
+
+        first = self.playlists.items[1 % len(self.playlists.items)]
+        self.player = {'device': self.devices[0], 'shuffle_state': False, 'repeat_state': 'off', 'is_playing': True, 'playlist': first['id'], 'position': 0, 'progress_ms': 0, 'started': time.time(), 'queue': []}
+
+    def _id(self):
+        return ''.join(self.rng.choice(BASE62) for _ in range(22))
+
+    def _images(self, kind, id):
+        return list(map(lambda size: {'url': 'https://i.scdn.co/image/{}{}{}'.format(kind, id, size), 'height': size, 'width': size}, (640, 300, 64)))
+
+    def _artist(self, idx):
+        id = self._id()
+        return {'external_urls': {'spotify': 'https://open.spotify.com/artist/' + id}, 'href': 'https://api.spotify.com/v1/artists/' + id, 'id': id, 'name': 'Artist {}'.format(idx), 'type': 'artist', 'uri': 'spotify:artist:' + id}
+
+    def _album(self, idx):
+        id = self._id()
+        return {'album_type': 'album', 'artists': [self.rng.choice(self.artists)], 'available_markets': MARKETS, 'external_urls': {'spotify': 'https://open.spotify.com/album/' + id},
+                'href': 'https://api.spotify.com/v1/albums/' + id, 'id': id, 'images': self._images('ab67616d', id), 'name': 'Album {}'.format(idx), 'release_date': '20{:02d}-01-01'.format(idx % 24),
+                'release_date_precision': 'day', 'total_tracks': 12, 'type': 'album', 'uri': 'spotify:album:' + id}
+
+    def _track(self, idx, uri=None):
+        id = uri.split(':')[-1] if uri is not None else self._id()
+        album = self.rng.choice(self.albums)
+        artists = album['artists'] + self.rng.sample(self.artists, self.rng.randint(0, 2))
+
+        return {'album': album, 'artists': artists, 'available_markets': MARKETS, 'disc_number': 1, 'duration_ms': self.rng.randint(120000, 360000), 'explicit': False,
+                'external_ids': {'isrc': 'USRC1{:07d}'.format(idx)}, 'external_urls': {'spotify': 'https://open.spotify.com/track/' + id}, 'href': 'https://api.spotify.com/v1/tracks/' + id,
+                'id': id, 'is_local': False, 'name': 'Track {}'.format(idx), 'popularity': self.rng.randint(0, 100), 'preview_url': None, 'track_number': idx % 12 + 1, 'type': 'track',
+                'uri': 'spotify:track:' + id}
+
+    def _playlist(self, idx, size):
+        id = self._id()
+        added = int(time.time() * 1000) - size * 60000
+
+        return {'collaborative': False, 'description': '', 'external_urls': {'spotify': 'https://open.spotify.com/playlist/' + id}, 'href': 'https://api.spotify.com/v1/playlists/' + id,
+                'id': id, 'images': self._images('ab67706c', id), 'name': 'Big Mix' if size >= 10000 else 'Playlist {}'.format(idx), 'owner': {'id': 'mockuser', 'display_name': 'Mock User', 'type': 'user', 'uri': 'spotify:user:mockuser'},
+                'public': True, 'snapshot_id': self._id(), 'type': 'playlist', 'uri': 'spotify:playlist:' + id,
+                'items': list(map(lambda i: {'added_at': isoformat(added + i * 60000), 'is_local': False, 'track': self.tracks[self.rng.randrange(len(self.tracks))]}, range(size)))}
+
+    def track(self, uri):
+        with self.lock:
+            if uri not in self.byUri:
+                self.byUri[uri] = self._track(len(self.byUri), uri=uri)
+
+            return self.byUri[uri]
+
+    def touch(self, playlist):
+        playlist['snapshot_id'] = self._id()
+
+        return playlist['snapshot_id']
+
+class OrderedPlaylists:
+    def __init__(self):
+        self.items = []
+        self.byId = {}
+
+    def add(self, playlist):
+        self.items.append(playlist)
+        self.byId[playlist['id']] = playlist
+
+    def get(self, id):
+        return self.byId.get(id)
+
+class Faults:
+    def __init__(self, latency=0, jitter=0, throttleEvery=0, rateLimit=0, window=30, retryAfter=1):
+        self.lock = threading.Lock()
+        self.configure(latency=latency, jitter=jitter, throttleEvery=throttleEvery, rateLimit=rateLimit, window=window, retryAfter=retryAfter)
+        self.reset()
+
+    def configure(self, **options):
+        with self.lock:
+            for key, value in options.items():
+                setattr(self, key, value)
+
+            self.calls = deque()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.calls = deque()
+            self.stats = {}
+
+    def record(self, key, status):
+        with self.lock:
+            counts = self.stats.setdefault(key, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+
+    def delay(self):
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep((self.latency + random.uniform(0, self.jitter)) / 1000)
+
+    def throttled(self):
+        # returns Retry-After seconds when this request should get a 429
+        with self.lock:
+            self.count += 1
+            now = time.time()
+
+            if self.throttleEvery > 0 and self.count % self.throttleEvery == 0:
+                return self.retryAfter
+
+            if self.rateLimit > 0:
+                while len(self.calls) > 0 and self.calls[0] <= now - self.window:
+                    self.calls.popleft()
+
+                if len(self.calls) >= self.rateLimit:
+                    return max(math.ceil(self.calls[0] + self.window - now), 1)
+
+                self.calls.append(now)
+
+        return None
+
+def page(items, limit, offset, url, wrap=None):
+    limit = max(1, limit)
+    chunk = items[offset:offset + limit]
+
+    nexturl = None
+    if offset + limit < len(items):
+        nexturl = '{}?offset={}&limit={}'.format(url, offset + limit, limit)
+
+    previous = None
+    if offset > 0:
+        previous = '{}?offset={}&limit={}'.format(url, max(offset - limit, 0), limit)
+
+    return {'href': '{}?offset={}&limit={}'.format(url, offset, limit), 'items': list(map(wrap, chunk)) if wrap is not None else chunk, 'limit': limit,
+            'next': nexturl, 'offset': offset, 'previous': previous, 'total': len(items)}
+
+def playlistSummary(playlist, base):
+    summary = dict((k, v) for k, v in playlist.items() if k != 'items')
+    summary['tracks'] = {'href': '{}/playlists/{}/tracks'.format(base, playlist['id']), 'total': len(playlist['items'])}
+
+    return summary
+
+def createApp(fixtures=None, faults=None):
+    app = Flask(__name__)
+    app.fixtures = fixtures if fixtures is not None else Fixtures()
+    app.faults = faults if faults is not None else Faults()
+
+    # authorization codes handed out by /authorize, with the PKCE challenge they were issued for
+    app.codes = {}
+
+    def error(status, message):
+        return jsonify({'error': {'status': status, 'message': message}}), status
+
+    def intArg(name, default, maximum=None):
+        try:
+            value = int(request.args.get(name, default))
+        except ValueError:
+            value = default
+
+        return min(value, maximum) if maximum is not None else value
+
+    def apiBase():
+        return request.host_url.rstrip('/') + '/v1'
+
+    def currentTrack():
+        player = app.fixtures.player
+        playlist = app.fixtures.playlists.get(player['playlist'])
+
+        if len(playlist['items']) == 0:
+            return None
+
+        return playlist['items'][player['position'] % len(playlist['items'])]['track']
+
+    def progress():
+        player = app.fixtures.player
+        if not player['is_playing']:
+            return player['progress_ms']
+
+        return player['progress_ms'] + int((time.time() - player['started']) * 1000)
+
+    @app.before_request
+    def inject():
+        if request.path.startswith('/_mock'):
+            return None
+
+        app.faults.delay()
+
+        if request.path.startswith('/v1'):
+            if not request.headers.get('Authorization', '').startswith('Bearer '):
+                return error(401, 'No token provided')
+
+            retry = app.faults.throttled()
+            if retry is not None:
+                res = jsonify({'error': {'status': 429, 'message': 'API rate limit exceeded'}})
+                res.status_code = 429
+                res.headers['Retry-After'] = str(retry)
+                return res
+
+        return None
+
+    @app.after_request
+    def finish(res):
+        if request.path.startswith('/_mock'):
+            return res
+
+        # ETag revalidation like the real API
+        if request.method == 'GET' and res.status_code == 200 and res.direct_passthrough is False:
+            etag = '"{}"'.format(hashlib.sha1(res.get_data()).hexdigest())
+            res.headers['ETag'] = etag
+
+            if request.headers.get('If-None-Match') == etag:
+                res = Response(status=304, headers={'ETag': etag})
+
+        app.faults.record('{} {}'.format(request.method, request.url_rule.rule if request.url_rule is not None else request.path), res.status_code)
+
+        return res
+
+    # consent is granted straight away, so setup can run unattended against the mock
+    @app.route('/authorize')
+    def authorize():
+        code = 'mock-code-' + hashlib.sha1(str(time.time()).encode('utf-8')).hexdigest()
+        app.codes[code] = (request.args.get('code_challenge'), request.args.get('scope', ''))
+
+        return redirect('{}?{}'.format(request.args.get('redirect_uri'), urlencode({'code': code, 'state': request.args.get('state', '')})))
+
+    @app.route('/api/token', methods=['POST'])
+    def token():
+        grant_type = request.form.get('grant_type')
+        data = {'access_token': 'mock-' + hashlib.sha1(str(time.time()).encode('utf-8')).hexdigest(), 'token_type': 'Bearer', 'expires_in': 3600, 'scope': ''}
+
+        if grant_type == 'authorization_code':
+            challenge, data['scope'] = app.codes.pop(request.form.get('code'), (None, ''))
+            verifier = request.form.get('code_verifier', '')
+
+            if challenge is not None and challenge != base64.urlsafe_b64encode(hashlib.sha256(verifier.encode('ascii')).digest()).decode('ascii').rstrip('='):
+                return jsonify({'error': 'invalid_grant', 'error_description': 'code_verifier was incorrect'}), 400
+
+            data['refresh_token'] = 'mock-refresh-' + hashlib.sha1(verifier.encode('utf-8')).hexdigest()
+        elif grant_type == 'refresh_token':
+            # like the real API, clients without a secret get a new refresh token every time
+            if 'client_id' in request.form:
+                data['refresh_token'] = 'mock-refresh-' + hashlib.sha1(str(time.time()).encode('utf-8')).hexdigest()
+        else:
+            return jsonify({'error': 'unsupported_grant_type'}), 400
+
+        return jsonify(data)
+
+    @app.route('/v1/me')
+    def me():
+        return jsonify({'display_name': 'Mock User', 'id': 'mockuser', 'type': 'user', 'uri': 'spotify:user:mockuser', 'followers': {'total': 0},
+                        'images': [{'url': 'https://i.scdn.co/image/mockuser300', 'height': 300, 'width': 300}, {'url': 'https://i.scdn.co/image/mockuser64', 'height': 64, 'width': 64}]})
+
+    @app.route('/v1/me/playlists')
+    def playlists():
+        base = apiBase()
+
+        return jsonify(page(app.fixtures.playlists.items, intArg('limit', 20, 50), intArg('offset', 0), base + '/me/playlists', lambda p: playlistSummary(p, base)))
+
+    @app.route('/v1/playlists/<id>')
+    def playlist(id):
+        playlist = app.fixtures.playlists.get(id)
+        if playlist is None:
+            return error(404, 'Not found.')
+
+        base = apiBase()
+        data = playlistSummary(playlist, base)
+        data['tracks'] = page(playlist['items'], 100, 0, '{}/playlists/{}/tracks'.format(base, id))
+
+        # only top-level fields are filtered, nested selections return the whole field
+        if request.args.get('fields'):
+            names = set(map(lambda f: re.split(r'[.(]', f)[0], re.sub(r'\([^)]*\)', '', request.args.get('fields')).split(',')))
+            data = dict((k, v) for k, v in data.items() if k in names)
+
+        return jsonify(data)
+
+    @app.route('/v1/playlists/<id>/tracks', methods=['GET', 'POST', 'DELETE', 'PUT'])
+    def playlistTracks(id):
+        playlist = app.fixtures.playlists.get(id)
+        if playlist is None:
+            return error(404, 'Not found.')
+
+        if request.method == 'GET':
+            return jsonify(page(playlist['items'], intArg('limit', 100, 100), intArg('offset', 0), '{}/playlists/{}/tracks'.format(apiBase(), id)))
+
+        body = request.get_json(silent=True) or {}
+
+        with app.fixtures.lock:
+            if request.method == 'POST':
+                uris = body.get('uris') or request.args.get('uris', '').split(',')
+                if len(uris) > 100:
+                    return error(400, 'Too many tracks requested')
+
+                added = isoformat(int(time.time() * 1000))
+                items = list(map(lambda uri: {'added_at': added, 'is_local': False, 'track': app.fixtures.byUri.get(uri) or None}, uris))
+                for item, uri in zip(items, uris):
+                    if item['track'] is None:
+                        item['track'] = app.fixtures._track(len(app.fixtures.byUri), uri=uri)
+                        app.fixtures.byUri[uri] = item['track']
+
+                position = body.get('position', len(playlist['items']))
+                playlist['items'][position:position] = items
+
+                return jsonify({'snapshot_id': app.fixtures.touch(playlist)}), 201
+
+            if request.method == 'DELETE':
+                tracks = body.get('tracks', [])
+                if len(tracks) > 100:
+                    return error(400, 'Too many tracks requested')
+
+                if body.get('snapshot_id') not in (None, playlist['snapshot_id']) and not any('positions' in t for t in tracks):
+                    return error(400, 'Invalid snapshot id')
+
+                positions = set()
+                for track in tracks:
+                    if 'positions' in track:
+                        positions.update(p for p in track['positions'] if p < len(playlist['items']) and playlist['items'][p]['track']['uri'] == track['uri'])
+                    else:
+                        positions.update(i for i, item in enumerate(playlist['items']) if item['track']['uri'] == track['uri'])
+
+                playlist['items'] = [item for i, item in enumerate(playlist['items']) if i not in positions]
+
+                return jsonify({'snapshot_id': app.fixtures.touch(playlist)})
+
+            # PUT either replaces every item or moves a range
+            if 'uris' in body:
+                playlist['items'] = list(map(lambda uri: {'added_at': isoformat(int(time.time() * 1000)), 'is_local': False, 'track': app.fixtures.track(uri)}, body.get('uris')))
+            else:
+                start = body.get('range_start', 0)
+                length = body.get('range_length', 1)
+                before = body.get('insert_before', 0)
+
+                moved = playlist['items'][start:start + length]
+                rest = playlist['items'][:start] + playlist['items'][start + length:]
+                if before > start:
+                    before -= length
+                playlist['items'] = rest[:before] + moved + rest[before:]
+
+            return jsonify({'snapshot_id': app.fixtures.touch(playlist)})
+
+    @app.route('/v1/me/player')
+    def player():
+        track = currentTrack()
+        if track is None:
+            return '', 204
+
+        player = app.fixtures.player
+        playlist = app.fixtures.playlists.get(player['playlist'])
+
+        return jsonify({'device': player['device'], 'shuffle_state': player['shuffle_state'], 'repeat_state': player['repeat_state'], 'timestamp': int(time.time() * 1000),
+                        'context': {'type': 'playlist', 'href': '{}/playlists/{}'.format(apiBase(), playlist['id']), 'uri': playlist['uri'], 'external_urls': playlist['external_urls']},
+                        'progress_ms': min(progress(), track['duration_ms']), 'item': track, 'currently_playing_type': 'track', 'is_playing': player['is_playing'],
+                        'actions': {'disallows': {'resuming': True}}})
+
+    @app.route('/v1/me/player/currently-playing')
+    def currentlyPlaying():
+        res = player()
+        if isinstance(res, tuple) or res.status_code != 200:
+            return res
+
+        data = res.get_json()
+        data.pop('device')
+
+        return jsonify(data)
+
+    @app.route('/v1/me/player/devices')
+    def devices():
+        return jsonify({'devices': app.fixtures.devices})
+
+    @app.route('/v1/me/player/<operation>', methods=['PUT', 'POST'])
+    def control(operation):
+        player = app.fixtures.player
+
+        deviceid = request.args.get('device_id')
+        if deviceid is not None:
+            device = next((d for d in app.fixtures.devices if d['id'] == deviceid), None)
+            if device is None:
+                return error(404, 'Device not found')
+
+            player['device'] = device
+
+        if operation == 'queue' and request.method == 'POST':
+            if not request.args.get('uri', '').startswith('spotify:'):
+                return error(400, 'Invalid track uri')
+
+            player['queue'].append(request.args.get('uri'))
+            return '', 204
+
+        if request.method != 'PUT':
+            return error(405, 'Method not allowed')
+
+        if operation in ('next', 'previous'):
+            player['position'] += 1 if operation == 'next' else -1
+            player['progress_ms'] = 0
+            player['started'] = time.time()
+        elif operation == 'play':
+            player['progress_ms'] = progress()
+            player['is_playing'] = True
+            player['started'] = time.time()
+        elif operation == 'pause':
+            player['progress_ms'] = progress()
+            player['is_playing'] = False
+        elif operation == 'shuffle':
+            player['shuffle_state'] = request.args.get('state', 'false').lower() == 'true'
+        elif operation == 'repeat':
+            if request.args.get('state') not in ('track', 'context', 'off'):
+                return error(400, 'Invalid repeat state')
+
+            player['repeat_state'] = request.args.get('state')
+        elif operation == 'seek':
+            player['progress_ms'] = intArg('position_ms', 0)
+            player['started'] = time.time()
+        else:
+            return error(404, 'Service not found')
+
+        return '', 204
+
+    @app.route('/v1/me/player/recently-played')
+    def recentlyPlayed():
+        limit = intArg('limit', 20, 50)
+        items = app.fixtures.recents
+
+        if request.args.get('after') is not None:
+            after = intArg('after', 0)
+            # the newest plays after the cursor, still newest first
+            items = [i for i in items if i['played_at_ms'] > after][-limit:]
+        elif request.args.get('before') is not None:
+            before = intArg('before', 0)
+            items = [i for i in items if i['played_at_ms'] < before][:limit]
+        else:
+            items = items[:limit]
+
+        def play(item):
+            playlist = item['playlist']
+            return {'track': item['track'], 'played_at': item['played_at'], 'context': {'type': 'playlist', 'href': '{}/playlists/{}'.format(apiBase(), playlist['id']), 'uri': playlist['uri']}}
+
+        data = {'items': list(map(play, items)), 'limit': limit, 'href': apiBase() + '/me/player/recently-played', 'next': None, 'cursors': None}
+        if len(items) > 0:
+            data['cursors'] = {'after': str(items[0]['played_at_ms']), 'before': str(items[-1]['played_at_ms'])}
+
+        return jsonify(data)
+
+    @app.route('/_mock/config', methods=['GET', 'POST'])
+    def config():
+        if request.method == 'POST':
+            app.faults.configure(**dict((k, v) for k, v in (request.get_json(silent=True) or {}).items() if k in ('latency', 'jitter', 'throttleEvery', 'rateLimit', 'window', 'retryAfter')))
+
+        return jsonify(dict((k, getattr(app.faults, k)) for k in ('latency', 'jitter', 'throttleEvery', 'rateLimit', 'window', 'retryAfter')))
+
+    @app.route('/_mock/stats', methods=['GET', 'DELETE'])
+    def stats():
+        if request.method == 'DELETE':
+            app.faults.reset()
+
+        return jsonify(app.faults.stats)
+
+    @app.route('/_mock/fixtures')
+    def fixtures():
+        playlists = app.fixtures.playlists.items
+
+        return jsonify({'playlists': list(map(lambda p: {'id': p['id'], 'name': p['name'], 'uri': p['uri'], 'total': len(p['items'])}, playlists)),
+                        'devices': list(map(lambda d: {'id': d['id'], 'name': d['name']}, app.fixtures.devices)),
+                        'tracks': list(map(lambda t: t['uri'], app.fixtures.tracks[:1000]))})
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Spotify Web API and accounts service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated fixtures')
+    parser.add_argument('--playlists', type=int, default=120, help='Number of playlists, the first one is the big one')
+    parser.add_argument('--big-playlist', type=int, default=10000, help='Tracks in the big playlist')
+    parser.add_argument('--recents', type=int, default=500, help='Plays in the recently played history')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='Up to this many random milliseconds added on top of --latency')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Answer every Nth API request with a 429')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Answer with a 429 once this many API requests fall within --window')
+    parser.add_argument('--window', type=float, default=30, help='Rolling window in seconds for --rate-limit')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with --throttle-every 429s')
+    args = parser.parse_args()
+
+    fixtures = Fixtures(seed=args.seed, playlists=args.playlists, bigPlaylist=args.big_playlist, recents=args.recents)
+    faults = Faults(latency=args.latency, jitter=args.jitter, throttleEvery=args.throttle_every, rateLimit=args.rate_limit, window=args.window, retryAfter=args.retry_after)
+
+    app = createApp(fixtures, faults)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# argv for each subcommand, parsed the same way the CLI does before it dispatches
+SUBCOMMANDS = {
+    'status': ['status'],
+    'status --render': ['status', '--render', '256'],
+    'playback': ['playback', 'next'],
+    'devices': ['devices'],
+    'playlist': ['playlist', 'add', 'playlist', '--song', 'spotify:track:0'],
+    'user recents': ['user', 'recents'],
+    'user status': ['user', 'status'],
+    'stats': ['stats'],
+    'batch': ['batch'],
+    'library index': ['library', 'index'],
+    'playlist find': ['playlist', 'find', '--nowplaying'],
+    'playlist sync': ['playlist', 'sync', 'playlist', '-'],
+    'playlist tracks': ['--json', 'playlist', 'tracks', 'playlist'],
+    'daemon': ['daemon', '--stop']
+}
+
+# modules only specific code paths need, none of them may load at startup
+HEAVY_MODULES = ['numpy', 'PIL', 'imgcat', 'bs4', 'flask', 'requests', 'urllib3', 'httpx', 'asyncio', 'webbrowser', 'subprocess', 'orjson']
+
+PROBE = '''
+import json
+import sys
+sys.path.insert(0, {repo!r})
+import pySpotify
+pySpotify.buildParser().parse_args({argv!r})
+print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))
+'''
+
+def probe(argv):
+    code = PROBE.format(repo=REPO_DIR, argv=argv, heavy=HEAVY_MODULES)
+
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+
+    imports_us = 0
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+
+        _, cumulative, name = line.split('|')
+        # top-level imports only, the interpreter's own site setup is not ours to budget
+        if cumulative.strip().isdigit() and not name.startswith('  ') and name.strip() != 'site':
+            imports_us += int(cumulative)
+
+    return imports_us / 1000, json.loads(res.stdout)
+
+def wallclock(argv, repeat):
+    code = PROBE.format(repo=REPO_DIR, argv=argv, heavy=HEAVY_MODULES)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], capture_output=True, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure pySpotify cold start per subcommand')
+    parser.add_argument('--repeat', type=int, default=5, help='Process launches per subcommand, the fastest one is reported')
+    parser.add_argument('--budget', type=float, default=200, help='Maximum milliseconds spent importing before a subcommand dispatches')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for name, argv in SUBCOMMANDS.items():
+        imports_ms, heavy = probe(argv)
+        results.append({'subcommand': name, 'imports_ms': round(imports_ms, 1), 'wall_ms': round(wallclock(argv, args.repeat), 1), 'heavy_modules': heavy, 'ok': imports_ms <= args.budget and len(heavy) == 0})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<14} {:>10} {:>10}  {}'.format('subcommand', 'imports ms', 'wall ms', 'heavy modules'))
+        for result in results:
+            print('{:<14} {:>10} {:>10}  {}{}'.format(result['subcommand'], result['imports_ms'], result['wall_ms'], ', '.join(result['heavy_modules']) or '-', '' if result['ok'] else '  OVER BUDGET'))
+
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!python3
+
+import argparse
+import json
+import math
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+
+sys.path.insert(0, REPO_DIR)
+
+import pySpotify
+
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class MockServer:
+    def __init__(self, latency=0, jitter=0, seed=0):
+        self.port = freePort()
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        self.options = ['--port', str(self.port), '--latency', str(latency), '--jitter', str(jitter), '--seed', str(seed)]
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'mockserver.py')] + self.options, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # building the fixtures takes a moment
+        deadline = time.time() + 30
+        while True:
+            try:
+                self.fixtures = self.control('/_mock/fixtures')
+                return self
+            except OSError:
+                if time.time() > deadline or self.proc.poll() is not None:
+                    self.proc.kill()
+                    raise Exception('Mock server did not start on {}'.format(self.url))
+
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def control(self, path, data=None, method=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        req = urllib.request.Request(self.url + path, data=body, method=method, headers={'Content-Type': 'application/json'})
+
+        with urllib.request.urlopen(req, timeout=5) as res:
+            return json.loads(res.read())
+
+    def requests(self):
+        return sum(sum(counts.values()) for counts in self.control('/_mock/stats').values())
+
+    def reset(self):
+        self.control('/_mock/stats', method='DELETE')
+
+def playlistId(server, name):
+    return next(p['id'] for p in server.fixtures['playlists'] if p['name'] == name)
+
+def throttle(server, every):
+    server.control('/_mock/config', {'throttleEvery': every, 'retryAfter': 1})
+
+# name, operations per run, run(client, server), and optional setup/teardown around every run
+CLIENT_BENCHMARKS = [
+    ('currentlyPlaying', 1, lambda c, s: c.currentlyPlaying(), None, None),
+    ('getPlayback', 1, lambda c, s: c.getPlayback(), None, None),
+    ('getDevices', 1, lambda c, s: c.getDevices(), None, None),
+    ('getPlaylists (120)', 120, lambda c, s: c.getPlaylists(), None, None),
+    ('resolvePlaylist', 1, lambda c, s: c.resolvePlaylist('playlist 77'), None, None),
+    ('getPlaylist alltracks (10k)', 10000, lambda c, s: c.getPlaylist(playlistId(s, 'Big Mix'), alltracks=True), None, None),
+    ('iterPlaylistTracks (10k)', 10000, lambda c, s: sum(1 for _ in c.iterPlaylistTracks(playlistId(s, 'Big Mix'))), None, None),
+    ('addToPlaylist (500)', 500, lambda c, s: c.addToPlaylist(playlistId(s, 'Playlist 2'), s.fixtures['tracks'][:500]),
+     None, lambda c, s: c.removeFromPlaylist(playlistId(s, 'Playlist 2'), s.fixtures['tracks'][:500])),
+    ('removeFromPlaylist (500)', 500, lambda c, s: c.removeFromPlaylist(playlistId(s, 'Playlist 2'), s.fixtures['tracks'][:500]),
+     lambda c, s: c.addToPlaylist(playlistId(s, 'Playlist 2'), s.fixtures['tracks'][:500]), None),
+    ('getRecentlyPlayed (50)', 50, lambda c, s: c.getRecentlyPlayed(limit=50), None, None),
+    ('controlPlayback next', 1, lambda c, s: c.controlPlayback('next'), None, None),
+    ('controlPlayback shuffle --device', 1, lambda c, s: c.controlPlayback('shuffle', device='Kitchen'), None, None),
+    ('batch queue (200)', 200, lambda c, s: list(c.batch(pySpotify.parseBatch('\n'.join(map(lambda uri: 'queue ' + uri, s.fixtures['tracks'][:200]))))), None, None),
+    ('queue with 429s (10)', 10, lambda c, s: [c.controlPlayback('queue', uri=uri) for uri in s.fixtures['tracks'][:10]],
+     lambda c, s: throttle(s, 5), lambda c, s: throttle(s, 0))
+]
+
+# argv for the CLI and what it reads on stdin, these run with the default rate limit
+SUBCOMMAND_BENCHMARKS = [
+    ('status', ['status'], None),
+    ('devices', ['devices'], None),
+    ('playback next', ['playback', 'next'], None),
+    ('playback shuffle --device', ['playback', '-d', 'Kitchen', 'shuffle'], None),
+    ('playlist add', ['playlist', 'add', 'Playlist 3', '--song', 'spotify:track:0000000000000000000000'], None),
+    ('playlist remove', ['playlist', 'remove', 'Playlist 3', '--song', 'spotify:track:0000000000000000000000'], None),
+    ('user recents', ['user', 'recents', '--limit', '50'], None),
+    ('batch (200 queue)', ['batch'], lambda s: '\n'.join(map(lambda uri: 'queue ' + uri, s.fixtures['tracks'][:200]))),
+    ('devices --all-accounts (8)', ['--all-accounts', 'devices'], None),
+    ('playback pause --all-accounts (8)', ['--all-accounts', 'playback', 'pause'], None)
+]
+
+# fan-out benchmarks run over the default account and these
+EXTRA_ACCOUNTS = 7
+
+def summarize(name, kind, timings, operations, requests):
+    ordered = sorted(timings)
+    median = statistics.median(ordered)
+
+    return {
+        'name': name,
+        'kind': kind,
+        'runs': len(ordered),
+        'min_ms': round(ordered[0] * 1000, 2),
+        'median_ms': round(median * 1000, 2),
+        'p95_ms': round(ordered[max(math.ceil(0.95 * len(ordered)) - 1, 0)] * 1000, 2),
+        'ops_per_s': round(operations / median, 1) if median > 0 else None,
+        'requests': requests
+    }
+
+def benchmarkClient(server, repeat, only=None):
+    results = []
+
+    session = pySpotify.createSession()
+
+    for name, operations, run, setup, teardown in CLIENT_BENCHMARKS:
+        if only is not None and only not in name:
+            continue
+
+        # a fresh scheduler per benchmark, so a 429 pause never carries over to the next one
+        scheduler = pySpotify.RequestScheduler()
+
+        client = pySpotify.Spotify('bW9jazptb2Nr', 'mock-refresh', session=session, scheduler=scheduler, apiurl=server.url + '/v1', accountsurl=server.url)
+        timings = []
+        requests = []
+
+        for _ in range(repeat + 1):
+            # every run starts cold so it measures the calls, not the cache
+            client.cache = pySpotify.TTLCache()
+            client.playlistIndex = None
+            client.profiler = pySpotify.RequestProfiler(name)
+
+            if setup is not None:
+                setup(client, server)
+
+            start = time.perf_counter()
+            run(client, server)
+            elapsed = time.perf_counter() - start
+
+            requests.append(len(client.profiler.records))
+            client.profiler = None
+
+            if teardown is not None:
+                teardown(client, server)
+
+            timings.append(elapsed)
+
+        # the first run also paid for the token and the connection
+        results.append(summarize(name, 'client', timings[1:], operations, requests[-1]))
+
+    session.close()
+
+    return results
+
+def benchmarkSubcommands(server, repeat, only=None):
+    results = []
+
+    with tempfile.TemporaryDirectory() as statedir:
+        config = os.path.join(statedir, 'secrets.conf')
+        with open(config, 'w') as configfd:
+            configfd.write('[Application Configuration]\napp token = bW9jazptb2Nr\nrefresh token = mock-refresh\n')
+
+            for idx in range(1, EXTRA_ACCOUNTS + 1):
+                configfd.write('\n[Account kiosk{}]\nrefresh token = mock-refresh-{}\n'.format(idx, idx))
+
+        env = dict(os.environ, PYSPOTIFY_API_URL=server.url + '/v1', PYSPOTIFY_ACCOUNTS_URL=server.url, PYSPOTIFY_STATE_DIR=statedir, PYSPOTIFY_CONFIG=config,
+                   PYSPOTIFY_SOCKET=os.path.join(statedir, 'daemon.sock'))
+
+        for name, argv, stdin in SUBCOMMAND_BENCHMARKS:
+            if only is not None and only not in name:
+                continue
+
+            script = stdin(server) if stdin is not None else None
+            timings = []
+            requests = 0
+
+            # one unmeasured run leaves the token and cache files a real user would have
+            for run in range(repeat + 1):
+                server.reset()
+
+                start = time.perf_counter()
+                res = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'pySpotify.py')] + argv, input=script, capture_output=True, text=True, env=env)
+                elapsed = time.perf_counter() - start
+
+                if res.returncode != 0:
+                    raise Exception('{} failed: {}'.format(' '.join(argv), res.stderr.strip().splitlines()[-1:]))
+
+                if run > 0:
+                    timings.append(elapsed)
+                    requests = server.requests()
+
+            results.append(summarize(name, 'subcommand', timings, 1, requests))
+
+    return results
+
+def compare(results, baseline, tolerance, minDelta):
+    previous = dict(map(lambda r: ((r['kind'], r['name']), r), baseline))
+    regressions = []
+
+    for result in results:
+        before = previous.get((result['kind'], result['name']))
+        if before is None:
+            result['change'] = None
+            continue
+
+        result['change'] = round(result['median_ms'] / before['median_ms'] - 1, 3) if before['median_ms'] > 0 else None
+
+        # small absolute differences are noise even when the ratio looks big
+        if result['median_ms'] > before['median_ms'] * (1 + tolerance) and result['median_ms'] - before['median_ms'] > minDelta:
+            regressions.append(result)
+
+    return regressions
+
+def printResults(results):
+    print('{:<11} {:<34} {:>5} {:>10} {:>10} {:>10} {:>11} {:>9} {:>8}'.format('kind', 'benchmark', 'runs', 'min ms', 'median ms', 'p95 ms', 'ops/s', 'requests', 'change'))
+
+    for result in results:
+        change = result.get('change')
+        print('{:<11} {:<34} {:>5} {:>10} {:>10} {:>10} {:>11} {:>9} {:>8}'.format(result['kind'], result['name'], result['runs'], result['min_ms'], result['median_ms'], result['p95_ms'],
+                                                                               result['ops_per_s'], result['requests'], '{:+.1%}'.format(change) if change is not None else '-'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pySpotify client methods and subcommands against a local mock of the Web API')
+    parser.add_argument('--repeat', type=int, default=5, help='Measured runs per benchmark')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds the mock server adds to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='Up to this many random milliseconds added on top of --latency')
+    parser.add_argument('--only', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--skip-client', action='store_true', help='Do not benchmark client methods')
+    parser.add_argument('--skip-subcommands', action='store_true', help='Do not benchmark CLI subcommands')
+    parser.add_argument('--save', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Compare against results saved earlier with --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Median slowdown against the baseline that counts as a regression')
+    parser.add_argument('--min-delta', type=float, default=2, help='Milliseconds a regression must also exceed')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    with MockServer(latency=args.latency, jitter=args.jitter) as server:
+        if not args.skip_client:
+            results += benchmarkClient(server, args.repeat, only=args.only)
+        if not args.skip_subcommands:
+            results += benchmarkSubcommands(server, args.repeat, only=args.only)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as baselinefd:
+            regressions = compare(results, json.load(baselinefd), args.tolerance, args.min_delta)
+
+    if args.save is not None:
+        with open(args.save, 'w') as savefd:
+            json.dump(results, savefd, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printResults(results)
+
+    if len(regressions) > 0:
+        print('\nRegressions against {}: {}'.format(args.baseline, ', '.join(map(lambda r: r['name'], regressions))), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
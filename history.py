@@ -0,0 +1,175 @@
+import sqlite3
+from datetime import datetime, timezone
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS plays (
+    played_at INTEGER PRIMARY KEY,
+    track_uri TEXT NOT NULL,
+    track TEXT,
+    artist_uri TEXT,
+    artist TEXT,
+    album TEXT,
+    duration_ms INTEGER,
+    context_uri TEXT
+);
+CREATE TABLE IF NOT EXISTS play_artists (
+    artist_uri TEXT NOT NULL,
+    played_at INTEGER NOT NULL,
+    artist TEXT,
+    PRIMARY KEY (artist_uri, played_at)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS plays_track ON plays (track_uri, played_at);
+CREATE INDEX IF NOT EXISTS plays_artist ON plays (artist_uri, played_at);
+CREATE INDEX IF NOT EXISTS play_artists_played ON play_artists (played_at);
+'''
+
+# bumped whenever older databases need filling in, see HistoryStore.migrate
+SCHEMA_VERSION = 1
+
+# the most items recently-played hands out per request
+PAGE_LIMIT = 50
+
+def parseTimestamp(value):
+    if value is None:
+        return None
+
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+
+    # played_at looks like 2016-12-13T20:44:04.589Z
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+
+    return int(timestamp.timestamp() * 1000)
+
+def playRow(item):
+    track = item.get('track', {})
+    artists = track.get('artists', [])
+    context = item.get('context') or {}
+
+    return (
+        parseTimestamp(item.get('played_at')),
+        track.get('uri'),
+        track.get('name'),
+        artists[0].get('uri') if len(artists) > 0 else None,
+        ', '.join(list(map(lambda x: x.get('name'), artists))),
+        track.get('album', {}).get('name'),
+        track.get('duration_ms'),
+        context.get('uri')
+    )
+
+def artistRows(item):
+    played_at = parseTimestamp(item.get('played_at'))
+    artists = filter(lambda a: a.get('uri'), item.get('track', {}).get('artists', []))
+
+    # every credited artist gets a row, not only the first one
+    return list(map(lambda a: (a.get('uri'), played_at, a.get('name')), artists))
+
+class HistoryStore:
+    COLUMNS = ('played_at', 'track_uri', 'track', 'artist_uri', 'artist', 'album', 'duration_ms', 'context_uri')
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+        if version < 1:
+            # plays synced before play_artists existed only know their first artist
+            with self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO play_artists SELECT artist_uri, played_at, NULL FROM plays WHERE artist_uri IS NOT NULL')
+
+        if version < SCHEMA_VERSION:
+            self.conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def close(self):
+        self.conn.close()
+
+    def latest(self):
+        return self.conn.execute('SELECT MAX(played_at) FROM plays').fetchone()[0]
+
+    def add(self, items):
+        items = list(items)
+
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany('INSERT OR IGNORE INTO plays VALUES (?, ?, ?, ?, ?, ?, ?, ?)', map(playRow, items))
+            added = self.conn.total_changes - before
+
+            self.conn.executemany('INSERT OR IGNORE INTO play_artists VALUES (?, ?, ?)', (row for item in items for row in artistRows(item)))
+
+        return added
+
+    def sync(self, client):
+        added = 0
+        after = self.latest()
+
+        # only ask for plays newer than the newest one already stored
+        while True:
+            data = client._recentlyPlayed(limit=PAGE_LIMIT, after=after, priority='bulk')
+            if data.get('status') != 'success':
+                raise Exception('Unable to retrieve recently played tracks')
+
+            items = data.get('items', [])
+            if len(items) == 0:
+                break
+
+            added += self.add(items)
+
+            newest = max(map(lambda i: parseTimestamp(i.get('played_at')), items))
+            if after is not None and newest <= after:
+                break
+
+            after = newest
+
+            if len(items) < PAGE_LIMIT:
+                break
+
+        return added
+
+    def query(self, since=None, until=None, limit=None, track=None, artist=None):
+        return list(self.iterQuery(since=since, until=until, limit=limit, track=track, artist=artist))
+
+    def iterQuery(self, since=None, until=None, limit=None, track=None, artist=None):
+        clauses = []
+        params = []
+
+        if since is not None:
+            clauses.append('played_at > ?')
+            params.append(parseTimestamp(since))
+
+        if until is not None:
+            clauses.append('played_at < ?')
+            params.append(parseTimestamp(until))
+
+        if track is not None:
+            clauses.append('(track_uri = ? OR track LIKE ?)')
+            params += [track, '%{}%'.format(track)]
+
+        if artist is not None:
+            # a uri matches featured artists too, a name matches anywhere in the credits
+            clauses.append('(played_at IN (SELECT played_at FROM play_artists WHERE artist_uri = ?) OR artist LIKE ?)')
+            params += [artist, '%{}%'.format(artist)]
+
+        sql = 'SELECT {} FROM plays'.format(', '.join(self.COLUMNS))
+        if len(clauses) > 0:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY played_at DESC'
+
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        # rows come off the cursor one at a time
+        return map(self._play, self.conn.execute(sql, params))
+
+    def _play(self, row):
+        play = dict(zip(self.COLUMNS, row))
+        play['uri'] = play.get('track_uri')
+
+        return play
@@ -0,0 +1,123 @@
+import contextvars
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlists (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    uri TEXT,
+    snapshot_id TEXT,
+    tracks_total INTEGER,
+    indexed_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS entries (
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track_uri TEXT,
+    track TEXT,
+    artist TEXT,
+    album_uri TEXT,
+    album TEXT,
+    PRIMARY KEY (playlist_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entry_artists (
+    artist_uri TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (artist_uri, playlist_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_track ON entries (track_uri);
+CREATE INDEX IF NOT EXISTS entries_album ON entries (album_uri);
+'''
+
+class LibraryIndex:
+    COLUMNS = ('playlist_id', 'playlist', 'playlist_uri', 'position', 'track_uri', 'track', 'artist', 'album_uri', 'album')
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM playlists').fetchone()[0]
+
+    def snapshots(self):
+        return dict(self.conn.execute('SELECT id, snapshot_id FROM playlists'))
+
+    def trackUris(self, playlist_id, snapshot_id):
+        row = self.conn.execute('SELECT snapshot_id FROM playlists WHERE id = ?', (playlist_id,)).fetchone()
+
+        # anything but the exact snapshot could be out of date
+        if row is None or row[0] != snapshot_id:
+            return None
+
+        return list(map(lambda r: r[0], self.conn.execute('SELECT track_uri FROM entries WHERE playlist_id = ? ORDER BY position', (playlist_id,))))
+
+    def _replace(self, playlist, tracks):
+        rows = []
+        artists = []
+
+        for position, track in enumerate(tracks):
+            rows.append((playlist.id, position, track.uri, track.name, track.artist, track.album_uri, track.album))
+            artists += map(lambda uri: (uri, playlist.id, position), filter(None, track.artist_uris))
+
+        with self.conn:
+            self.conn.execute('DELETE FROM entries WHERE playlist_id = ?', (playlist.id,))
+            self.conn.execute('DELETE FROM entry_artists WHERE playlist_id = ?', (playlist.id,))
+            self.conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.executemany('INSERT OR IGNORE INTO entry_artists VALUES (?, ?, ?)', artists)
+            self.conn.execute('INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?, ?)', (playlist.id, playlist.name, playlist.uri, playlist.snapshot_id, len(rows), int(time.time())))
+
+    def _drop(self, ids):
+        with self.conn:
+            for table, column in (('playlists', 'id'), ('entries', 'playlist_id'), ('entry_artists', 'playlist_id')):
+                self.conn.executemany('DELETE FROM {} WHERE {} = ?'.format(table, column), map(lambda i: (i,), ids))
+
+    def refresh(self, client, full=False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        known = self.snapshots()
+
+        # a cached listing could hide snapshots changed by other clients
+        playlists = list(client.iterPlaylists(fresh=True))
+
+        # a playlist's contents only change together with its snapshot_id
+        changed = list(filter(lambda p: full or known.get(p.id) != p.snapshot_id, playlists))
+        removed = set(known) - set(map(lambda p: p.id, playlists))
+
+        # pages are fetched in parallel, sqlite is only written from this thread; the
+        # workers run in copies of this context so --profile still sees their requests
+        context = contextvars.copy_context()
+
+        with ThreadPoolExecutor(max_workers=client.workers) as executor:
+            for playlist, tracks in zip(changed, executor.map(lambda p: context.copy().run(lambda: list(client.iterPlaylistTracks(p.id))), changed)):
+                self._replace(playlist, tracks)
+
+        self._drop(removed)
+
+        return {'playlists': len(playlists), 'updated': len(changed), 'removed': len(removed), 'unchanged': len(playlists) - len(changed)}
+
+    def _query(self, join, where, params):
+        sql = 'SELECT e.playlist_id, p.name, p.uri, e.position, e.track_uri, e.track, e.artist, e.album_uri, e.album FROM entries e JOIN playlists p ON p.id = e.playlist_id'
+        sql += join + ' WHERE ' + where + ' ORDER BY p.name COLLATE NOCASE, e.playlist_id, e.position'
+
+        return list(map(lambda row: dict(zip(self.COLUMNS, row)), self.conn.execute(sql, params)))
+
+    def findTracks(self, uris):
+        return self._query('', 'e.track_uri IN ({})'.format(', '.join('?' * len(uris))), list(uris))
+
+    def findArtist(self, artist):
+        # a uri goes through the inverted index, a name has to scan the display names
+        if artist.startswith('spotify:artist:'):
+            return self._query(' JOIN entry_artists a ON a.playlist_id = e.playlist_id AND a.position = e.position', 'a.artist_uri = ?', (artist,))
+
+        return self._query('', 'e.artist LIKE ?', ('%{}%'.format(artist),))
+
+    def findAlbum(self, album):
+        if album.startswith('spotify:album:'):
+            return self._query('', 'e.album_uri = ?', (album,))
+
+        return self._query('', 'e.album LIKE ?', ('%{}%'.format(album),))
@@ -1,49 +1,833 @@
 #!python3
 
 import configparser
-import urllib
-import requests
+import urllib.parse
 import sys
 import os
-import subprocess
-import webbrowser
 import time
 import re
-from base64 import b64encode
-from bs4 import BeautifulSoup
-import numpy as np
-from PIL import Image
-import imgcat
-from argparsejson import argparsejson
+import hashlib
+import io
+import contextlib
+import contextvars
+import signal
+import socket
+import socketserver
+import tempfile
+import json
+import shlex
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict, Counter
+from base64 import b64encode, b64decode, urlsafe_b64encode
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def parse_config():
+VERBOSE_STDOUT = open(os.devnull, 'w')
+
+# overridable so a mock server or a second setup never touches the real account
+STATE_DIR = os.environ.get('PYSPOTIFY_STATE_DIR', SCRIPT_DIR)
+CONFIG_FILE = os.environ.get('PYSPOTIFY_CONFIG', os.path.join(STATE_DIR, 'secrets.conf'))
+API_URL = os.environ.get('PYSPOTIFY_API_URL', 'https://api.spotify.com/v1')
+ACCOUNTS_URL = os.environ.get('PYSPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+
+# calls per 30 seconds, by default only 429s from Spotify slow requests down
+RATE_LIMIT = int(os.environ.get('PYSPOTIFY_RATE_LIMIT')) if os.environ.get('PYSPOTIFY_RATE_LIMIT') else None
+
+# the account in [Application Configuration], others live in [Account <name>] sections
+DEFAULT_ACCOUNT = 'default'
+
+# filled in by the timed connection classes for the request running on each thread
+CONNECTION_TIMINGS = threading.local()
+
+DAEMON_SOCKET = os.environ.get('PYSPOTIFY_SOCKET', os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()), 'pySpotify-{}.sock'.format(os.getuid())))
+
+def parse_accounts(configfile=None):
     config = configparser.ConfigParser()
 
-    config.read(os.path.join(SCRIPT_DIR, 'secrets.conf'))
+    config.read(configfile if configfile is not None else CONFIG_FILE)
+
+    sections = list(filter(lambda s: s.startswith('Account '), config.sections()))
 
     if 'Application Configuration' in config:
-        app_config = config['Application Configuration']
+        base = config['Application Configuration']
+    elif len(sections) > 0:
+        base = {}
     else:
         raise Exception('Missing config section!')
 
-    app_token = app_config.get('app token')
-    refresh_token = app_config.get('refresh token')
+    accounts = OrderedDict()
+
+    if base.get('refresh token'):
+        accounts[DEFAULT_ACCOUNT] = {'app_token': base.get('app token'), 'refresh_token': base.get('refresh token'), 'client_id': base.get('client id')}
+
+    for section in sections:
+        app_config = config[section]
+
+        # accounts authorized through the same application only need their refresh token,
+        # an account with its own application must not mix in the default app's credentials
+        if 'app token' in app_config or 'client id' in app_config:
+            app = app_config
+        else:
+            app = base
+
+        accounts[section[len('Account '):].strip()] = {
+            'app_token': app.get('app token'),
+            'refresh_token': app_config.get('refresh token'),
+            'client_id': app.get('client id')
+        }
+
+    if len(accounts) == 0:
+        raise Exception('No accounts configured, run setup first!')
+
+    return accounts
+
+def parse_config(account=None):
+    accounts = parse_accounts()
+
+    if account is None:
+        return next(iter(accounts.values()))
+    if account not in accounts:
+        raise Exception('Unknown account \'{}\'! Configured accounts: {}'.format(account, ', '.join(accounts)))
+
+    return accounts[account]
+
+def statePath(filename, account=None):
+    if account is None or account == DEFAULT_ACCOUNT:
+        return os.path.join(STATE_DIR, filename)
+
+    # tokens, caches and history all belong to one account
+    accountdir = os.path.join(STATE_DIR, 'accounts', re.sub(r'[^\w.-]', '_', account))
+    os.makedirs(accountdir, mode=0o700, exist_ok=True)
+
+    return os.path.join(accountdir, filename)
+
+def readTokenCache(tokenfile, refresh_token):
+    config = configparser.ConfigParser()
+
+    config.read(tokenfile)
+
+    if 'Access Token' not in config:
+        return None
+
+    token_config = config['Access Token']
+
+    # a cached token only belongs to the refresh token that produced it
+    if token_config.get('owner') != tokenOwner(refresh_token):
+        return None
+
+    try:
+        expires_at = token_config.getfloat('expires at')
+    except (TypeError, ValueError):
+        return None
+
+    return {'access_token': token_config.get('access token'), 'expires_at': expires_at, 'refresh_token': token_config.get('refresh token')}
+
+def writeTokenCache(tokenfile, refresh_token, access_token, expires_at, rotated_token=None):
+    config = configparser.ConfigParser()
+    config['Access Token'] = {'owner': tokenOwner(refresh_token), 'access token': access_token, 'expires at': str(expires_at)}
+
+    # PKCE refresh tokens are single use, the owner stays the configured one
+    if rotated_token is not None:
+        config['Access Token']['refresh token'] = rotated_token
+
+    # a unique name so clients refreshing at once never replace each other's file
+    tmpfd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(tokenfile) or '.', prefix=os.path.basename(tokenfile) + '.', suffix='.tmp')
+    with os.fdopen(tmpfd, 'w') as tokenfd:
+        config.write(tokenfd)
+
+    os.replace(tmpfile, tokenfile)
+
+def refreshRequest(app_token, client_id, refresh_token):
+    payload = {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
+
+    if app_token:
+        headers = {'Authorization': 'Basic {}'.format(app_token)}
+    else:
+        # PKCE clients have no secret and identify themselves in the body
+        headers = {}
+        payload['client_id'] = client_id
+
+    return headers, payload
+
+def tokenOwner(refresh_token):
+    return hashlib.sha256((refresh_token or '').encode('utf-8')).hexdigest()[:16]
+
+def connectionTimings(reset=False):
+    timings = getattr(CONNECTION_TIMINGS, 'timings', None)
+    if timings is None or reset:
+        timings = CONNECTION_TIMINGS.timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+
+    return timings
+
+def timedPool(pool):
+    from urllib3.exceptions import NewConnectionError
+
+    class TimedConnection(pool.ConnectionCls):
+        def _new_conn(self):
+            host = self._dns_host
+            timings = connectionTimings()
+
+            start = time.perf_counter()
+            try:
+                addresses = list(dict.fromkeys(map(lambda a: a[4][0], socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM))))
+            except socket.gaierror:
+                # let urllib3 raise its own resolution error
+                addresses = [host]
+            resolved = time.perf_counter()
+            timings['dns'] += resolved - start
+
+            # connect to the resolved addresses so the lookup is not repeated
+            try:
+                for idx, address in enumerate(addresses):
+                    self._dns_host = address
+                    try:
+                        return super()._new_conn()
+                    except NewConnectionError:
+                        if idx == len(addresses) - 1:
+                            raise
+            finally:
+                self._dns_host = host
+                timings['connect'] += time.perf_counter() - resolved
+
+        def connect(self):
+            timings = connectionTimings()
+            before = timings['dns'] + timings['connect']
+
+            start = time.perf_counter()
+            super().connect()
+
+            # whatever connect() spent beyond the socket itself is the TLS handshake
+            if pool.scheme == 'https':
+                timings['tls'] += max(time.perf_counter() - start - (timings['dns'] + timings['connect'] - before), 0)
+
+    return type('Timed' + pool.__name__, (pool,), {'ConnectionCls': TimedConnection})
+
+def createSession(pool_size=10, retries=3, backoff=0.5):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+
+    # 429s are left to the RequestScheduler, which also covers POST and PUT
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504), respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    adapter.poolmanager.pool_classes_by_scheme = {'http': timedPool(HTTPConnectionPool), 'https': timedPool(HTTPSConnectionPool)}
+
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+def cacheKey(method, url, params=None):
+    if params:
+        url += '?' + urllib.parse.urlencode(sorted(params.items()))
+
+    return '{} {}'.format(method, url)
+
+class TTLCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            # least recently used entries fall off the front
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, prefix=''):
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                del self.entries[key]
+
+    def save(self):
+        pass
+
+    def close(self):
+        self.save()
+
+class DiskCache(TTLCache):
+    # every command loads and rewrites the whole file, so it has to stay small
+    def __init__(self, path, maxsize=256, maxbytes=1024 * 1024):
+        super().__init__(maxsize=maxsize)
+
+        self.path = path
+        self.maxbytes = maxbytes
+        self.dirty = False
+
+        try:
+            with open(self.path) as cachefd:
+                for key, entry in json.load(cachefd):
+                    self.entries[key] = entry
+        except (OSError, ValueError):
+            self.entries.clear()
+
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry.get('expires', 0) < now and not entry.get('etag')]:
+            del self.entries[key]
+
+    def set(self, key, entry):
+        super().set(key, entry)
+        self.dirty = True
+
+    def invalidate(self, prefix=''):
+        super().invalidate(prefix)
+        self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            # most recently used first, anything that no longer fits stays in memory only
+            kept = []
+            size = 0
+            for item in reversed(self.entries.items()):
+                line = json.dumps(item)
+                if size + len(line) <= self.maxbytes:
+                    kept.append(line)
+                    size += len(line)
+
+            tmpfile = self.path + '.tmp'
+            with open(tmpfile, 'w') as cachefd:
+                cachefd.write('[' + ', '.join(reversed(kept)) + ']')
+
+            os.replace(tmpfile, self.path)
+            self.dirty = False
+
+class CachedResponse:
+    def __init__(self, entry):
+        self.status_code = entry.get('status_code')
+        self.text = entry.get('body')
+        self.headers = {'ETag': entry.get('etag')} if entry.get('etag') else {}
+        self.from_cache = True
+
+    def json(self):
+        return json.loads(self.text)
+
+class RequestScheduler:
+    PRIORITIES = ('interactive', 'bulk')
+
+    # Spotify counts calls over a rolling 30 second window, but does not publish the limit,
+    # so without one only Retry-After pauses requests
+    def __init__(self, limit=None, window=30, reserve=0.2, retries=3, backoff=1, maxDelay=60):
+        self.capacity = limit or None
+        self.rate = limit / window if self.capacity else None
+        self.tokens = float(limit or 0)
+        self.updated = time.monotonic()
+
+        # share of the bucket bulk requests may not touch, kept for interactive ones
+        self.reserve = (limit or 0) * reserve
+
+        self.retries = retries
+        self.backoff = backoff
+        self.maxDelay = maxDelay
+
+        self.blockedUntil = 0
+        self.waiting = dict.fromkeys(self.PRIORITIES, 0)
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.capacity is None:
+            return
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority='interactive'):
+        if priority not in self.PRIORITIES:
+            raise Exception('Invalid request priority: {}'.format(priority))
+
+        with self.cond:
+            self.waiting[priority] += 1
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+
+                    # bulk requests step aside while an interactive one is queued
+                    if priority == 'bulk' and self.waiting['interactive'] > 0:
+                        self.cond.wait()
+                        continue
+
+                    needed = 1 if priority == 'interactive' else 1 + self.reserve
+
+                    if now >= self.blockedUntil and self.capacity is None:
+                        return
+
+                    if now >= self.blockedUntil and self.tokens >= needed:
+                        self.tokens -= 1
+                        return
+
+                    refill = (needed - self.tokens) / self.rate if self.capacity is not None else 0
+                    self.cond.wait(max(self.blockedUntil - now, refill, 0.01))
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+    def throttled(self, retryAfter, attempt=0):
+        try:
+            delay = float(retryAfter)
+        except (TypeError, ValueError):
+            delay = self.backoff * 2 ** attempt
+
+        if delay > self.maxDelay:
+            return None
+
+        # every lane pauses, and the bucket starts empty once the pause is over
+        with self.cond:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + delay)
+            self.tokens = 0
+            self.updated = self.blockedUntil
+            self.cond.notify_all()
+
+        return delay
+
+def inContext(fn):
+    # threads start with an empty context, this hands workers their command's memo, profiler and output
+    context = contextvars.copy_context()
+
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+        # responses kept while a command runs, or None outside of one; the daemon
+        # runs several commands on one client at once, each with its own memo
+        self.memo = contextvars.ContextVar('memo', default=None)
+        self.memos = []
+        self.saved = 0
+        self.savedBy = Counter()
+
+    @contextlib.contextmanager
+    def scope(self):
+        if self.memo.get() is not None:
+            yield self
+            return
+
+        memo = {}
+        token = self.memo.set(memo)
+        with self.lock:
+            self.memos.append(memo)
+
+        try:
+            yield self
+        finally:
+            self.memo.reset(token)
+            with self.lock:
+                self.memos.remove(memo)
+
+    def forget(self):
+        # a write can change what any earlier read returned, in every running command
+        with self.lock:
+            for memo in self.memos:
+                memo.clear()
+
+    def do(self, key, fn, memo=True):
+        from concurrent.futures import Future
+
+        # memo=False only joins a request already in flight, pages are never kept
+        memo = self.memo.get() if memo else None
+
+        with self.lock:
+            if memo is not None and key in memo:
+                self._count(key)
+                return memo.get(key), True
+
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+            else:
+                self._count(key)
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.inflight[key]
+
+            # errors and throttled responses are worth asking again
+            if memo is not None and result[0].status_code < 300:
+                memo[key] = result
+
+        future.set_result(result)
+        return result, False
+
+    def _count(self, key):
+        self.saved += 1
+        self.savedBy[endpointName(key.split(' ', 1)[1])] += 1
+
+def endpointName(url):
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith('/v1/'):
+        path = path[3:]
+
+    # base62 ids would give every playlist and track its own row
+    return re.sub(r'/[0-9A-Za-z]{22}(?=/|$)', '/{id}', path)
+
+class RequestProfiler:
+    # Prometheus metric name and the record field each one sums up
+    METRICS = (
+        ('pyspotify_requests_total', None),
+        ('pyspotify_request_seconds_total', 'total'),
+        ('pyspotify_response_bytes_total', 'bytes'),
+        ('pyspotify_request_retries_total', 'retries')
+    )
+
+    def __init__(self, command=None):
+        self.command = command
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, **fields):
+        with self.lock:
+            self.records.append(dict(fields, command=self.command))
+
+    def summary(self):
+        rows = OrderedDict()
+
+        for record in self.records:
+            key = (record.get('caller'), record.get('method'), record.get('endpoint'))
+            row = rows.setdefault(key, {'caller': key[0], 'method': key[1], 'endpoint': key[2], 'calls': 0, 'statuses': set(), 'hits': 0, 'shared': 0, 'retries': 0, 'bytes': 0, 'dns': 0.0, 'connect': 0.0, 'tls': 0.0, 'total': 0.0, 'max': 0.0})
+
+            row['calls'] += 1
+            row['statuses'].add(record.get('status'))
+            row['hits'] += 1 if record.get('cache') == 'hit' else 0
+            row['shared'] += 1 if record.get('cache') == 'coalesced' else 0
+            row['retries'] += record.get('retries')
+            row['bytes'] += record.get('bytes')
+            for timing in ('dns', 'connect', 'tls', 'total'):
+                row[timing] += record.get(timing)
+            row['max'] = max(row['max'], record.get('total'))
+
+        return sorted(rows.values(), key=lambda r: r['total'], reverse=True)
+
+    def printReport(self, file=None):
+        total = sum(map(lambda r: r.get('total'), self.records))
+        shared = sum(map(lambda r: r.get('cache') == 'coalesced', self.records))
+
+        msg = 'Profile for \'{}\': {} requests, {} shared with an identical one, {:.1f} ms\n'.format(self.command, len(self.records), shared, total * 1000)
+        msg += '{:>5} {:<6} {:<32} {:>7} {:>4} {:>6} {:>7} {:>9} {:>7} {:>7} {:>7} {:>9} {:>9}  {}\n'.format('calls', 'method', 'endpoint', 'status', 'hits', 'shared', 'retries', 'bytes', 'dns', 'connect', 'tls', 'total ms', 'max ms', 'caller')
+
+        for row in self.summary():
+            msg += '{:>5} {:<6} {:<32} {:>7} {:>4} {:>6} {:>7} {:>9} {:>7.1f} {:>7.1f} {:>7.1f} {:>9.1f} {:>9.1f}  {}\n'.format(
+                row['calls'], row['method'], row['endpoint'], ','.join(sorted(map(str, row['statuses']))), row['hits'], row['shared'], row['retries'], row['bytes'],
+                row['dns'] * 1000, row['connect'] * 1000, row['tls'] * 1000, row['total'] * 1000, row['max'] * 1000, row['caller'] or '-')
+
+        print(msg, file=file if file is not None else sys.stderr, flush=True)
+
+    def exportJson(self, path):
+        with open(path, 'a') as exportfd:
+            for record in self.records:
+                exportfd.write(json.dumps(record) + '\n')
+
+    def exportPrometheus(self, path):
+        counters = OrderedDict()
+
+        # counters keep growing across invocations, so start from the last export
+        try:
+            with open(path) as exportfd:
+                for line in exportfd:
+                    if not line.startswith('#') and ' ' in line:
+                        series, value = line.rstrip('\n').rsplit(' ', 1)
+                        counters[series] = float(value)
+        except (OSError, ValueError):
+            counters.clear()
+
+        for record in self.records:
+            labels = ','.join(map(lambda k: '{}="{}"'.format(k, str(record.get(k) if record.get(k) is not None else 'none').replace('"', '\\"')), ('command', 'method', 'endpoint', 'status', 'cache')))
+
+            for metric, field in self.METRICS:
+                series = '{}{{{}}}'.format(metric, labels)
+                counters[series] = counters.get(series, 0) + (record.get(field) if field is not None else 1)
+
+        msg = ''
+        for metric, field in self.METRICS:
+            msg += '# TYPE {} counter\n'.format(metric)
+            for series, value in counters.items():
+                if series.startswith(metric + '{'):
+                    msg += '{} {}\n'.format(series, float(value) if field == 'total' else int(value))
+
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'w') as exportfd:
+            exportfd.write(msg)
+
+        os.replace(tmpfile, path)
+
+def chunked(iterable, size):
+    batch = []
+
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+def planPlaylistSync(current, desired, batchSize=100):
+    import difflib
+
+    # autojunk would treat tracks that repeat a lot as noise in long playlists
+    matcher = difflib.SequenceMatcher(None, current, desired, autojunk=False)
+
+    removed = []
+    inserted = []
+
+    # tracks are followed by their index in current, duplicates stay apart that way
+    source = {}
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            source.update(zip(range(j1, j2), range(i1, i2)))
+        if tag in ('delete', 'replace'):
+            removed += map(lambda i: (i, current[i]), range(i1, i2))
+        if tag in ('insert', 'replace'):
+            inserted += map(lambda j: (j, desired[j]), range(j1, j2))
+
+    # a track that leaves one place and shows up in another is moved, which keeps its added_at
+    pending = {}
+    for i, uri in removed:
+        pending.setdefault(uri, []).append(i)
+
+    adds = []
+    for j, uri in inserted:
+        if len(pending.get(uri, [])) > 0:
+            source[j] = pending[uri].pop(0)
+        else:
+            adds.append((j, uri))
+
+    moved = set(map(lambda j: source[j], filter(lambda j: j in source, map(lambda i: i[0], inserted))))
+    removes = list(filter(lambda r: r[0] not in moved, removed))
+
+    plan = []
+
+    # highest positions first, so every batch is also valid against the playlist as it is now
+    removes.sort(reverse=True)
+    for batch in chunked(removes, batchSize):
+        tracks = OrderedDict()
+        for i, uri in batch:
+            tracks.setdefault(uri, []).append(i)
+
+        plan.append({'op': 'remove', 'uris': list(map(lambda r: r[1], batch)), 'tracks': list(map(lambda t: {'uri': t[0], 'positions': t[1]}, tracks.items()))})
+
+    # everything that was not moved is already in order, so each moved track (or run of
+    # them) only has to go right behind whatever precedes it in the wanted order
+    gone = set(map(lambda r: r[0], removes))
+    state = list(filter(lambda i: i not in gone, range(len(current))))
+    target = list(map(lambda j: source[j], filter(lambda j: j in source, range(len(desired)))))
+
+    t = 0
+    while t < len(target):
+        if target[t] not in moved:
+            t += 1
+            continue
+
+        start = state.index(target[t])
+        length = 1
+        while t + length < len(target) and target[t + length] in moved and start + length < len(state) and state[start + length] == target[t + length]:
+            length += 1
+
+        before = state.index(target[t - 1]) + 1 if t > 0 else 0
+
+        if not start <= before <= start + length:
+            plan.append({'op': 'move', 'uris': list(map(lambda i: current[i], state[start:start + length])), 'range_start': start, 'range_length': length, 'insert_before': before})
+
+            block = state[start:start + length]
+            del state[start:start + length]
+            if before > start:
+                before -= length
+            state[before:before] = block
+
+        t += length
+
+    # front to back again, so each insert position already counts everything before it
+    run = []
+    for j, uri in adds + [(None, None)]:
+        if len(run) > 0 and (j is None or j != run[0][0] + len(run) or len(run) == batchSize):
+            plan.append({'op': 'add', 'uris': list(map(lambda a: a[1], run)), 'position': run[0][0]})
+            run = []
 
-    return {'app_token': app_token, 'refresh_token': refresh_token}
+        if j is not None:
+            run.append((j, uri))
+
+    return plan
+
+def trackUri(value):
+    value = value.strip()
+    if value.startswith('spotify:'):
+        return value
+
+    # share links and bare ids as well as uris
+    match = re.fullmatch(r'(?:https?://open\.spotify\.com/(?:intl-\w+/)?(track|episode)/)?([0-9A-Za-z]{22})(?:\?.*)?', value)
+    if match is None:
+        raise Exception('Not a track uri, link or id: {}'.format(value))
+
+    return 'spotify:{}:{}'.format(match.group(1) or 'track', match.group(2))
+
+def parseTrackList(text):
+    return list(map(trackUri, filter(lambda l: len(l) > 0 and not l.startswith('#'), map(str.strip, text.splitlines()))))
+
+def normalizeName(name):
+    return ' '.join(unicodedata.normalize('NFKC', name or '').casefold().split())
+
+class PlaylistIndex:
+    def __init__(self, playlists=None):
+        self.playlists = {}
+        self.byName = {}
+        self.names = []
+        self._suffixes = None
+
+        if playlists is not None:
+            self.update(playlists)
+
+    def update(self, playlists):
+        seen = set()
+        changed = False
+
+        for playlist in playlists:
+            playlistid = playlist.get('id')
+            seen.add(playlistid)
+
+            current = self.playlists.get(playlistid)
+            if current is not None and current.get('snapshot_id') == playlist.get('snapshot_id') and current.get('name') == playlist.get('name'):
+                continue
+
+            if current is not None:
+                self._remove(playlistid)
+
+            self._add({'id': playlistid, 'name': playlist.get('name'), 'uri': playlist.get('uri'), 'snapshot_id': playlist.get('snapshot_id')})
+            changed = True
+
+        for playlistid in set(self.playlists) - seen:
+            self._remove(playlistid)
+            changed = True
+
+        if changed:
+            self.names = sorted(self.byName)
+            self._suffixes = None
+
+        return changed
+
+    def _add(self, playlist):
+        self.playlists[playlist['id']] = playlist
+        self.byName.setdefault(normalizeName(playlist.get('name')), []).append(playlist['id'])
+
+    def _remove(self, playlistid):
+        playlist = self.playlists.pop(playlistid)
+        name = normalizeName(playlist.get('name'))
+
+        ids = self.byName.get(name, [])
+        if playlistid in ids:
+            ids.remove(playlistid)
+        if len(ids) == 0:
+            self.byName.pop(name, None)
+
+    def resolve(self, playlist):
+        if playlist.startswith('spotify:playlist:'):
+            playlist = playlist.split(':')[-1]
+
+        if playlist in self.playlists:
+            return playlist
+
+        name = normalizeName(playlist)
+        if name in self.byName:
+            return self.byName[name][0]
+
+        idx = bisect_left(self.names, name)
+        if idx < len(self.names) and self.names[idx].startswith(name):
+            return self.byName[self.names[idx]][0]
+
+        if self._suffixes is None:
+            # every suffix of every name, so substrings become prefix searches
+            self._suffixes = sorted((n[start:], n) for n in self.names for start in range(1, len(n)))
+
+        idx = bisect_left(self._suffixes, (name,))
+        if idx < len(self._suffixes) and self._suffixes[idx][0].startswith(name):
+            return self.byName[self._suffixes[idx][1]][0]
+
+        return None
+
+    def toDict(self):
+        return {'playlists': list(self.playlists.values())}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data.get('playlists', []))
+
+# every scope a non-partner application can request, refreshed with fetchScopes
+SCOPES = ['ugc-image-upload', 'user-read-playback-state', 'user-modify-playback-state', 'user-read-currently-playing', 'app-remote-control', 'streaming',
+          'playlist-read-private', 'playlist-read-collaborative', 'playlist-modify-private', 'playlist-modify-public', 'user-follow-modify', 'user-follow-read',
+          'user-read-playback-position', 'user-top-read', 'user-read-recently-played', 'user-library-modify', 'user-library-read', 'user-read-email', 'user-read-private',
+          'user-personalized']
+
+# the scopes the commands in commands.json actually use
+DEFAULT_SCOPES = ['user-read-playback-state', 'user-modify-playback-state', 'user-read-currently-playing', 'playlist-read-private', 'playlist-read-collaborative',
+                  'playlist-modify-private', 'playlist-modify-public', 'user-read-recently-played', 'user-read-private']
+
+SCOPES_FILE = os.path.join(STATE_DIR, 'scopes.json')
+
+def loadScopes():
+    try:
+        with open(SCOPES_FILE) as scopesfd:
+            return json.load(scopesfd)
+    except (OSError, ValueError):
+        return list(SCOPES)
+
+def fetchScopes():
+    import requests
+    from bs4 import BeautifulSoup
 
-def getScopes():
     print('Retrieving valid scopes from Spotify...')
 
-    url = 'https://developer.spotify.com/documentation/general/guides/scopes'
-    html_data = requests.get(url).text
+    url = 'https://developer.spotify.com/documentation/web-api/concepts/scopes'
+    html_data = requests.get(url, timeout=10).text
     soup = BeautifulSoup(html_data, 'html.parser')
     codes = soup.find_all('code')
 
-    scopes = list(map(lambda c: c.text, codes))
+    # the page also has code samples, only keep things shaped like a scope
+    scopes = list(OrderedDict.fromkeys(filter(lambda c: re.fullmatch(r'[a-z]+(-[a-z]+)+', c), map(lambda c: c.text.strip(), codes))))
+    if len(scopes) == 0:
+        print('No scopes found, keeping the bundled list')
+        return loadScopes()
+
+    with open(SCOPES_FILE, 'w') as scopesfd:
+        json.dump(scopes, scopesfd)
 
-    remaining_scopes = scopes
+    return scopes
+
+def chooseScopes(scopes):
+    remaining_scopes = list(scopes)
     chosen_scopes = []
 
     choice = None
@@ -70,67 +854,108 @@ def getScopes():
 
     print('CURRENTLY CHOSEN SCOPES: {}'.format(len(chosen_scopes)), file=VERBOSE_STDOUT, flush=True)
     print(chosen_scopes, file=VERBOSE_STDOUT, flush=True)
-        
+
     return chosen_scopes
 
-def startFlaskHandler():
-    cmd = 'python {}'.format(os.path.join(SCRIPT_DIR, 'app.py'))
+def pkcePair():
+    import secrets
 
-    proc = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    verifier = secrets.token_urlsafe(64)
+    challenge = urlsafe_b64encode(hashlib.sha256(verifier.encode('ascii')).digest()).decode('ascii').rstrip('=')
 
-    return proc
+    return verifier, challenge
 
-def setupSpotify(clientid, clientsecret, configfile='secrets.conf'):
-    if configfile == 'secrets.conf':
-        configfile = os.path.join(SCRIPT_DIR, configfile)
+def authorize(clientid, scopes, redirect_uri='http://127.0.0.1:5000', openBrowser=True, timeout=300):
+    import secrets
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
-    app_token = b64encode('{}:{}'.format(clientid, clientsecret).encode('utf-8')).decode('utf-8')
-    print('APP TOKEN: {}'.format(app_token), file=VERBOSE_STDOUT, flush=True)
+    verifier, challenge = pkcePair()
+    state = secrets.token_urlsafe(16)
 
-    scopes = getScopes()
+    redirect = urllib.parse.urlsplit(redirect_uri)
+    received = {}
 
-    proc = startFlaskHandler()
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
 
-    baseurl = 'https://accounts.spotify.com'
+            # browsers also ask for a favicon, only the redirect itself counts
+            if url.path.rstrip('/') != redirect.path.rstrip('/') or ('code' not in query and 'error' not in query):
+                self.send_response(404)
+                self.end_headers()
+                return
 
-    redirect_uri = 'http://127.0.0.1:5000'
+            received.update(query)
 
-    params = {'client_id': clientid, 'response_type': 'code', 'redirect_uri': redirect_uri, 'scope': ' '.join(scopes)}
+            body = 'Authorization {}, you can close this window.'.format('failed' if 'error' in query else 'complete').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-    url = baseurl + '/authorize' + '/?' + urllib.parse.urlencode(params)
-    print(url)
-    webbrowser.open_new(url)
+        def log_message(self, format, *args):
+            print('CALLBACK: {}'.format(format % args), file=VERBOSE_STDOUT, flush=True)
 
-    wait = True
+    # listen before the browser opens so the redirect can never arrive first
+    server = HTTPServer((redirect.hostname, redirect.port or 80), CallbackHandler)
 
-    while wait is True:
-        choice = input('Has the authentication code been retrieved? (Y/N): ').lower()
-        if choice != 'y' and choice != 'n':
-            print('Error! Please pick either \'Y\' or \'N\'.')
-        elif choice == 'y':
-            wait = False
-        elif choice == 'n':
-            waittime = 2
-            print('Sleeping for {} seconds...'.format(waittime))
-            time.sleep(waittime)
+    params = {'client_id': clientid, 'response_type': 'code', 'redirect_uri': redirect_uri, 'scope': ' '.join(scopes), 'state': state,
+              'code_challenge_method': 'S256', 'code_challenge': challenge}
 
-    proc.terminate()
-    flask_stdout = proc.stdout.read()
+    url = ACCOUNTS_URL + '/authorize?' + urllib.parse.urlencode(params)
+    print('Open this URL to authorize the application:\n{}'.format(url))
 
-    code_matches = re.findall(r"RECEIVED CODE: (.*)", flask_stdout)
-    if len(code_matches) > 0:
-        code = code_matches.pop()
-    else:
-        code = None
+    if openBrowser:
+        import webbrowser
+        webbrowser.open_new(url)
+
+    deadline = time.time() + timeout
+
+    try:
+        while len(received) == 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception('Timed out waiting for the authorization callback!')
+
+            server.timeout = remaining
+            server.handle_request()
+    finally:
+        server.server_close()
 
-    if code is None:
-        raise Exception('Did not successfully receive code!')
+    if received.get('state') != state:
+        raise Exception('Authorization callback had the wrong state!')
+    if 'error' in received:
+        raise Exception('Authorization failed: {}'.format(received.get('error')))
 
-    payload = {'grant_type': 'authorization_code', 'code': code, 'redirect_uri': redirect_uri}
+    return received.get('code'), verifier
 
-    headers = {'Authorization': 'Basic {}'.format(app_token)}
+def setupSpotify(clientid, clientsecret=None, configfile=None, scopes=None, redirect_uri='http://127.0.0.1:5000', openBrowser=True, timeout=300, account=None):
+    import requests
 
-    res = requests.post(baseurl + '/api/token', data=payload, headers=headers)
+    if configfile is None:
+        configfile = CONFIG_FILE
+
+    if scopes is None:
+        scopes = DEFAULT_SCOPES
+
+    app_token = None
+    if clientsecret is not None:
+        app_token = b64encode('{}:{}'.format(clientid, clientsecret).encode('utf-8')).decode('utf-8')
+        print('APP TOKEN: {}'.format(app_token), file=VERBOSE_STDOUT, flush=True)
+
+    code, verifier = authorize(clientid, scopes, redirect_uri=redirect_uri, openBrowser=openBrowser, timeout=timeout)
+
+    payload = {'grant_type': 'authorization_code', 'code': code, 'redirect_uri': redirect_uri, 'code_verifier': verifier}
+
+    if app_token is not None:
+        headers = {'Authorization': 'Basic {}'.format(app_token)}
+    else:
+        headers = {}
+        payload['client_id'] = clientid
+
+    res = requests.post(ACCOUNTS_URL + '/api/token', data=payload, headers=headers, timeout=10)
     if res.status_code != 200:
         print(res.url, file=VERBOSE_STDOUT, flush=True)
         print(res.status_code, file=VERBOSE_STDOUT, flush=True)
@@ -142,316 +967,739 @@ def setupSpotify(clientid, clientsecret, configfile='secrets.conf'):
 
     refresh_token = data.get('refresh_token')
 
+    app_config = {'client id': clientid, 'refresh token': refresh_token}
+    if app_token is not None:
+        app_config['app token'] = app_token
+
+    # other accounts in the file stay as they are
     config = configparser.ConfigParser()
-    config['Application Configuration'] = {'app token': app_token, 'refresh token': refresh_token}
+    config.read(configfile)
+
+    if account is None or account == DEFAULT_ACCOUNT:
+        config['Application Configuration'] = app_config
+    else:
+        config['Account {}'.format(account)] = app_config
 
     with open(configfile, 'w') as configfd:
         config.write(configfd)
 
     print('Successfully setup Spotify application!')
-    print('Application Token and Refresh Token values are stored in {}'.format(configfile))
-
-def showImage(url):
-    data = urllib.request.urlopen(url)
-
-    img = Image.open(data)
-    imgcat.imgcat(img)
+    print('Client ID and Refresh Token values are stored in {}'.format(configfile))
 
-def printCurrentlyPlaying(data, showimg=False):
-    if data.get('status', 'erorr') == 'success':
-        if showimg is True:
-            showImage(data.get('artwork'))
-
-        msg = 'Now Playing:\n'
-        msg += 'Track: {}\n'.format(data.get('track'))
-        msg += 'Artist: {}\n'.format(data.get('artist'))
-        msg += 'Album: {}\n'.format(data.get('album'))
-        if data.get('playlist', None) is not None:
-            msg += 'Playlist: {}\n'.format(data.get('playlist'))
+# all a played track needs to know about the playlist it was played from
+PLAYLIST_CONTEXT_FIELDS = 'name,uri'
 
-        msg += 'URI: {}\n'.format(data.get('uri'))
+def playlistContextId(song_obj):
+    context = song_obj.get('context', {})
+    if context and context.get('type') == 'playlist':
+        return context.get('href').split('/')[-1]
 
-        if data.get('playlist_uri', None) is not None:
-            msg += 'Playlist URI: {}\n'.format(data.get('playlist_uri'))
+    return None
 
-        print(msg)
-    else:
-        raise Exception(data.get('error'))
+class Model:
+    __slots__ = ()
 
-def printControlPlayback(data):
-    print(data.get('status'), data.get('status_code'), data.get('error', None))
+    # the keys toDict() and the dict-style accessors expose
+    FIELDS = ()
 
-def printDevices(data):
-    print(data)
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
 
-def printRecents(data):
-    print('\n'.join(list(map(lambda s: '\'{}\' by \'{}\' - \'{}\''.format(s.get('track'), s.get('artist'), s.get('album')), data))))
+        return default if value is None else value
 
-class Spotify:
-    VALID_OPERATIONS = {
-        'playback': ['play', 'pause', 'next', 'previous', 'shuffle', 'repeat', 'queue', 'seek'],
-        'playlist': ['add', 'remove']
-    }
+    def __getitem__(self, key):
+        if key not in self.FIELDS and not hasattr(self, key):
+            raise KeyError(key)
 
-    def __init__(self, application_token, refresh_token):
-        self.baseurl = 'https://{}.spotify.com/{}'
-        self.apiurl = self.baseurl.format('api', 'v1')
+        return getattr(self, key)
 
-        self.app_token = application_token
-        self.refresh_token = refresh_token
+    def __contains__(self, key):
+        return key in self.FIELDS
 
-        self.access_token = self.get_access_token()
-        self.headers = {'Authorization': 'Bearer {}'.format(self.access_token)}
+    def toDict(self):
+        return dict(map(lambda k: (k, getattr(self, k)), self.FIELDS))
 
-    def request_token(self):
-        headers = {'Authorization': 'Basic {}'.format(self.app_token)}
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.toDict())
+
+class Track(Model):
+    __slots__ = ('name', 'uri', 'album', 'album_uri', 'artists', 'artist_uris', 'artwork', 'duration_ms', 'playlist', 'playlist_uri', 'played_at', 'added_at', 'raw', 'artwork_data', '_artist')
+
+    FIELDS = ('status', 'track', 'artist', 'album', 'uri', 'artwork', 'playlist', 'playlist_uri', 'duration_ms', 'played_at', 'added_at')
+
+    # only tracks that parsed cleanly are ever built
+    status = 'success'
+
+    def __init__(self, name=None, uri=None, album=None, album_uri=None, artists=(), artist_uris=(), artwork=None, duration_ms=None, playlist=None, playlist_uri=None, played_at=None, added_at=None, raw=None):
+        self.name = name
+        self.uri = uri
+        self.album = album
+        self.album_uri = album_uri
+        self.artists = artists
+        self.artist_uris = artist_uris
+        self.artwork = artwork
+        self.duration_ms = duration_ms
+        self.playlist = playlist
+        self.playlist_uri = playlist_uri
+        self.played_at = played_at
+        self.added_at = added_at
+        self.raw = raw
+        self.artwork_data = None
+        self._artist = None
+
+    @classmethod
+    def fromJson(cls, song_obj, playlist_data=None, keepRaw=False):
+        # accepts a bare track as well as the player, recents and playlist wrappers around one
+        if 'item' in song_obj:
+            song = song_obj.get('item') or {}
+        elif 'track' in song_obj:
+            song = song_obj.get('track') or {}
+        else:
+            song = song_obj
 
-        payload = {'grant_type': 'refresh_token', 'refresh_token': self.refresh_token}
+        album = song.get('album') or {}
+        images = album.get('images') or []
+        artists = song.get('artists') or []
 
-        res = requests.post(self.baseurl.format('accounts', 'api') + '/token', headers=headers, data=payload)
-        if res.status_code == 200:
-            return res.json()
+        if len(images) > 1:
+            artwork = images[1].get('url')
+        elif len(images) > 0:
+            artwork = images[0].get('url')
         else:
-            print(res.json(), file=VERBOSE_STDOUT, flush=True)
-            return res.json()
+            artwork = None
+
+        return cls(
+            name=song.get('name'),
+            uri=song.get('uri'),
+            album=album.get('name'),
+            album_uri=album.get('uri'),
+            artists=tuple(map(lambda x: x.get('name'), artists)),
+            artist_uris=tuple(map(lambda x: x.get('uri'), artists)),
+            artwork=artwork,
+            duration_ms=song.get('duration_ms'),
+            playlist=playlist_data.get('name') if playlist_data is not None else None,
+            playlist_uri=playlist_data.get('uri') if playlist_data is not None else None,
+            played_at=song_obj.get('played_at'),
+            added_at=song_obj.get('added_at'),
+            raw=song if keepRaw else None
+        )
+
+    def setPlaylist(self, playlist_data):
+        self.playlist = playlist_data.get('name') if playlist_data is not None else None
+        self.playlist_uri = playlist_data.get('uri') if playlist_data is not None else None
+
+    @property
+    def track(self):
+        return self.name
+
+    @property
+    def artist(self):
+        if self._artist is None:
+            self._artist = ', '.join(self.artists)
+
+        return self._artist
+
+    @property
+    def id(self):
+        return self.uri.split(':')[-1] if self.uri else None
+
+class Device(Model):
+    __slots__ = ('id', 'name', 'type', 'is_active', 'is_restricted', 'volume_percent', 'raw')
+
+    FIELDS = ('id', 'name', 'type', 'is_active', 'is_restricted', 'volume_percent')
+
+    def __init__(self, id=None, name=None, type=None, is_active=False, is_restricted=False, volume_percent=None, raw=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.is_active = is_active
+        self.is_restricted = is_restricted
+        self.volume_percent = volume_percent
+        self.raw = raw
+
+    @classmethod
+    def fromJson(cls, device):
+        # device lists are short, the full payload keeps the printout unchanged
+        return cls(id=device.get('id'), name=device.get('name'), type=device.get('type'), is_active=device.get('is_active', False), is_restricted=device.get('is_restricted', False), volume_percent=device.get('volume_percent'),
+                   raw=device)
+
+class Playlist(Model):
+    __slots__ = ('id', 'name', 'uri', 'snapshot_id', 'owner_id', 'tracks_total', 'public', 'collaborative')
+
+    FIELDS = __slots__
+
+    def __init__(self, id=None, name=None, uri=None, snapshot_id=None, owner_id=None, tracks_total=None, public=None, collaborative=False):
+        self.id = id
+        self.name = name
+        self.uri = uri
+        self.snapshot_id = snapshot_id
+        self.owner_id = owner_id
+        self.tracks_total = tracks_total
+        self.public = public
+        self.collaborative = collaborative
+
+    @classmethod
+    def fromJson(cls, playlist):
+        return cls(id=playlist.get('id'), name=playlist.get('name'), uri=playlist.get('uri'), snapshot_id=playlist.get('snapshot_id'), owner_id=(playlist.get('owner') or {}).get('id'),
+                   tracks_total=(playlist.get('tracks') or {}).get('total'), public=playlist.get('public'), collaborative=playlist.get('collaborative', False))
+
+class PlaybackState(Model):
+    __slots__ = ('status', 'status_code', 'is_playing', 'progress_ms', 'shuffle_state', 'repeat_state', 'device', 'item', 'context_type', 'context_uri', 'context_href')
+
+    FIELDS = __slots__
+
+    def __init__(self, status='error', status_code=None, is_playing=False, progress_ms=None, shuffle_state=False, repeat_state='off', device=None, item=None, context_type=None, context_uri=None, context_href=None):
+        self.status = status
+        self.status_code = status_code
+        self.is_playing = is_playing
+        self.progress_ms = progress_ms
+        self.shuffle_state = shuffle_state
+        self.repeat_state = repeat_state
+        self.device = device
+        self.item = item
+        self.context_type = context_type
+        self.context_uri = context_uri
+        self.context_href = context_href
+
+    @classmethod
+    def fromJson(cls, data, status_code=200, keepRaw=False):
+        context = data.get('context') or {}
+
+        return cls(
+            status='success',
+            status_code=status_code,
+            is_playing=data.get('is_playing', False),
+            progress_ms=data.get('progress_ms'),
+            shuffle_state=data.get('shuffle_state', False),
+            repeat_state=data.get('repeat_state', 'off'),
+            device=Device.fromJson(data.get('device')) if data.get('device') else None,
+            item=Track.fromJson(data, keepRaw=keepRaw) if data.get('item') else None,
+            context_type=context.get('type'),
+            context_uri=context.get('uri'),
+            context_href=context.get('href')
+        )
+
+    def playlistId(self):
+        if self.context_type == 'playlist' and self.context_href is not None:
+            return self.context_href.split('/')[-1]
+
+        return None
+
+    def toDict(self):
+        data = super().toDict()
+        data['device'] = self.device.toDict() if self.device is not None else None
+        data['item'] = self.item.toDict() if self.item is not None else None
 
-    def get_access_token(self):
-        return self.request_token().get('access_token')
+        return data
 
-    def getCurrentUser(self):
-        url = self.apiurl + '/me'
+def songData(song_obj, playlist_data=None, keepRaw=False):
+    return Track.fromJson(song_obj, playlist_data, keepRaw=keepRaw)
 
-        res = requests.get(url, headers=self.headers)
-        print(res.json(), file=VERBOSE_STDOUT, flush=True)
-        data = res.json()
+class ArtworkCache:
+    # terminal cells are roughly this many pixels wide and tall
+    CELL_SIZE = (8, 16)
 
-        if res.status_code == 200:
-            data['status'] = 'connected'
-        else:
-            data['status'] = 'disconnected'
+    def __init__(self, path, maxbytes=64 * 1024 * 1024):
+        self.path = path
+        self.maxbytes = maxbytes
 
-        return data
+        os.makedirs(self.path, exist_ok=True)
 
-    def playlist(self, operation, playlist, songs, device=None):
-        userplaylists = self.getPlaylists()
-        playlists = list(map(lambda x: (x.get('name'), x.get('id')), userplaylists.get('items')))
+    def _key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
 
-        playlistid = None
+    def _read(self, path):
+        with open(path, 'rb') as imgfd:
+            data = imgfd.read()
 
-        for name in list(map(lambda x: x[0], playlists)):
-            if playlist in name:
-                # playlist is in name list
-                playlistid = playlists[list(map(lambda x: x[0], playlists)).index(name)][-1]
+        # reads count as use for eviction
+        os.utime(path)
 
-        if playlistid is None:
-            if id in list(map(lambda x: x[-1], playlists)):
-                # playlist is in id list
-                playlistid = id
-            else: 
-                raise Exception('Invalid playlist name or id!')
+        return data
 
-        if operation not in self.VALID_OPERATIONS.get('playlist'):
-            raise Exception('Invalid playlist operation!')
+    def _write(self, path, data):
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as imgfd:
+            imgfd.write(data)
 
-        if operation == 'add':
-            pass
-        elif operation == 'remove':
-            return self.removeFromPlaylist(playlistid, songs, device=device)
+        os.replace(tmpfile, path)
+        self.evict()
 
+    def cached(self, url):
+        path = os.path.join(self.path, self._key(url))
 
-    def getPlaylists(self):
-        url = self.apiurl + '/users/{}/playlists'.format(self.getCurrentUser().get('id'))
+        return self._read(path) if os.path.exists(path) else None
 
-        res = requests.get(url, headers=self.headers)
+    def original(self, url, imgdata=None):
+        import urllib.request
 
-        data = {}
-        data['status_code'] = res.status_code
+        path = os.path.join(self.path, self._key(url))
 
-        if res.status_code == 200:
-            data['status'] = 'success'
-            data.update(res.json())
-        else:
-            data['status'] = 'error'
+        if os.path.exists(path):
+            return self._read(path)
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+        if imgdata is None:
+            with urllib.request.urlopen(url) as res:
+                imgdata = res.read()
 
-        return data
+        self._write(path, imgdata)
 
-    def getPlaylist(self, id):
-        url = self.apiurl + '/playlists/{}'.format(id)
+        return imgdata
 
-        res = requests.get(url, headers=self.headers)
+    def render(self, url, size, imgdata=None):
+        from PIL import Image
 
-        data = {}
-        data['status_code'] = res.status_code
+        path = os.path.join(self.path, '{}.{}x{}.png'.format(self._key(url), size[0], size[1]))
 
-        if res.status_code == 200:
-            data['status'] = 'success'
-            data.update(res.json())
-        else:
-            data['status'] = 'error'
+        if os.path.exists(path):
+            return self._read(path)
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+        img = Image.open(io.BytesIO(self.original(url, imgdata)))
+        img.thumbnail(size)
 
-        return data
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        self._write(path, buf.getvalue())
 
-    def addToPlaylist(self, playlistid, songid):
-        pass
+        return buf.getvalue()
 
-    def removeFromPlaylist(self, playlistid, songids, device=None):
-        url = self.apiurl + '/playlists/{}/tracks'.format(playlistid)
-        print(url)
+    def ansi(self, url, columns, rows, mode, imgdata=None):
+        import artwork
 
-        payload = {'tracks': list({'uri': songid} for songid in songids)}
-        print(payload)
+        # swatches do not scale with the terminal, but their colors depend on it
+        if mode == 'palette':
+            columns, rows = 0, 0
+            mode = 'palette-truecolor' if terminalTruecolor() else 'palette-256'
 
-        res = requests.delete(url, headers=self.headers, data=payload)
+        path = os.path.join(self.path, '{}.{}x{}.{}.ansi'.format(self._key(url), columns, rows, mode))
 
-        data = {}
-        data['status_code'] = res.status_code
+        if os.path.exists(path):
+            return self._read(path).decode('utf-8')
 
-        if res.status_code == 200:
-            data['status'] = 'success'
-            data.update(res.json())
+        original = self.original(url, imgdata)
+
+        if mode.startswith('palette'):
+            text = artwork.renderPalette(original, truecolor=mode == 'palette-truecolor')
         else:
-            data['status'] = 'error'
-            print(res.json())
+            text = artwork.renderAnsi(original, columns, rows, truecolor=mode == 'truecolor')
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+        self._write(path, text.encode('utf-8'))
 
-        if device is not None:
-            self.controlPlayback('next', device=device)
+        return text
 
-        return data
+    def evict(self):
+        entries = list(filter(lambda e: e.is_file() and not e.name.endswith('.tmp'), os.scandir(self.path)))
+        total = sum(map(lambda e: e.stat().st_size, entries))
 
-    def currentlyPlaying(self):
-        url = self.apiurl + '/me/player/currently-playing'
+        # least recently used files go first
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.maxbytes:
+                break
 
-        res = requests.get(url, headers=self.headers)
-        print(res.status_code, file=VERBOSE_STDOUT, flush=True)
-        if res.status_code == 200:
-            data = res.json()
+            total -= entry.stat().st_size
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
 
-            print(data, file=VERBOSE_STDOUT, flush=True)
+    @classmethod
+    def terminalSize(cls):
+        columns, lines = terminalInfo().get('size')
 
-            return self._getSongData(data)
-        elif res.status_code == 204:
-            return {'status': 'error', 'error': 'No track currently playing'}
+        # leave room below the image for the track details
+        return (max(1, columns) * cls.CELL_SIZE[0], max(1, lines - 9) * cls.CELL_SIZE[1])
 
-    def getPlayback(self):
-        url = self.apiurl + '/me/player'
+    @classmethod
+    def terminalCells(cls):
+        columns, lines = terminalInfo().get('size')
 
-        res = requests.get(url, headers=self.headers)
+        return (max(1, columns), max(1, lines - 9))
 
-        data = {'status_code': res.status_code}
-        if res.status_code == 200:
-            data['status'] = 'success'
-            data.update(res.json())
-        else:
-            data['status'] = 'error'
+# ways showImage can draw artwork, 'auto' picks one for the terminal it runs in
+RENDERERS = ['auto', 'imgcat', 'truecolor', '256', 'palette']
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+# environment variables that say what a terminal can draw
+TERMINAL_ENV = ('TERM_PROGRAM', 'COLORTERM', 'TMUX')
 
-        return data
+# the terminal of the client a daemon is serving, in place of the daemon's own; set per
+# command, since the daemon serves several clients at once
+CLIENT_TERMINAL = contextvars.ContextVar('terminal', default=None)
 
-    def controlPlayback(self, operation, device=None, uri=None, seekOffset=0):
-        operation = operation.lower()
-        if operation not in self.VALID_OPERATIONS['playback']:
-            raise Exception('Invalid playback operation!')
+def terminalInfo():
+    if CLIENT_TERMINAL.get() is not None:
+        return CLIENT_TERMINAL.get()
 
-        url = self.apiurl + '/me/player/{}'.format(operation)
+    import shutil
 
-        params = {}
+    return {'env': dict((name, os.environ.get(name)) for name in TERMINAL_ENV), 'size': tuple(shutil.get_terminal_size())}
 
-        if device:
-            deviceid = self._getDeviceId(device)
+def terminalTruecolor():
+    return (terminalInfo().get('env').get('COLORTERM') or '').lower() in ('truecolor', '24bit')
 
-            params['device_id'] = deviceid
+def showImage(url, imgdata=None, cache=None, mode='auto'):
+    if mode not in RENDERERS:
+        raise Exception('Unknown renderer \'{}\'! Pick one of {}'.format(mode, ', '.join(RENDERERS)))
 
-        if operation == 'shuffle':
-            params['state'] = self.getPlayback().get('shuffle_state', False)
-            params['state'] = not params['state']
-        elif operation == 'repeat':
-            params['state'] = self.getPlayback().get('repeat_state', False)
-            params['state'] = 'context' if params['state'] == 'off' else 'off'
-        elif operation == 'queue':
-            params['uri'] = uri
-        elif operation == "seek":
-            song = self.currentlyPlaying()
-            duration = int(song['raw']['duration_ms'])
-            seekPos = round(duration * (seekOffset/4))
-            params['position_ms'] = seekPos
-
-        if operation == 'queue':
-            res = requests.post(url, headers=self.headers, params=params)
-        else:
-            res = requests.put(url, headers=self.headers, params=params)
+    if cache is None:
+        cache = ArtworkCache(os.path.join(STATE_DIR, 'artwork'))
 
-        data = {'status_code': res.status_code}
-        if res.status_code == 204:
-            data['status'] = 'success'
+    if mode == 'auto':
+        # only iTerm2 and WezTerm show inline images, everything else gets half blocks
+        env = terminalInfo().get('env')
+        if env.get('TERM_PROGRAM') in ('iTerm.app', 'WezTerm') and env.get('TMUX') is None:
+            mode = 'imgcat'
         else:
-            data['status'] = 'error'
+            mode = 'truecolor' if terminalTruecolor() else '256'
 
-            if res.status_code == 404:
-                data['error'] = 'device not found'
-            elif res.status_code == 403:
-                data['error'] = 'unable to perform operation: {}'.format(operation)
-            else:
-                data['error'] = 'undocumented error'
+    if mode == 'imgcat':
+        import imgcat
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+        imgcat.imgcat(cache.render(url, ArtworkCache.terminalSize(), imgdata))
+    else:
+        columns, rows = ArtworkCache.terminalCells()
 
-        return data
+        sys.stdout.write(cache.ansi(url, columns, rows, mode, imgdata))
+        sys.stdout.flush()
 
-    def _getDevices(self):
-        url = self.apiurl + '/me/player/devices'
+# filled in on first use with orjson's encoder when it is installed
+JSON_ENCODER = None
 
-        res = requests.get(url, headers=self.headers)
-        
-        data = {'status_code': res.status_code}
-        if res.status_code == 200:
-            data['status'] = 'success'
+def jsonDefault(obj):
+    if isinstance(obj, Model):
+        return obj.toDict()
 
-            data.update(res.json())
-        else:
-            data['status'] = 'error'
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
 
-        print(data, file=VERBOSE_STDOUT, flush=True)
+def toJson(obj):
+    global JSON_ENCODER
 
-        return data
+    if JSON_ENCODER is None:
+        try:
+            import orjson
 
-    def getDevices(self):
-        data = self._getDevices()
+            JSON_ENCODER = lambda o: orjson.dumps(o, default=jsonDefault, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except ImportError:
+            JSON_ENCODER = lambda o: json.dumps(o, default=jsonDefault)
 
-        if data.get('status') == 'success':
-            devices = {}
-            for device in data.get('devices'):
-                devices[device['name']] = device
+    return JSON_ENCODER(obj)
 
-            return devices
-        else:
-            raise Exception('Unable to retrieve devices')
+def printJson(obj, flush=False):
+    sys.stdout.write(toJson(obj) + '\n')
 
-    def _getDeviceId(self, device):
-        devices = self.getDevices()
+    if flush:
+        sys.stdout.flush()
 
-        deviceid = None
+def streamJson(items):
+    # one line per item as it arrives, the buffer hands them on whenever it fills
+    count = 0
+    for item in items:
+        sys.stdout.write(toJson(item) + '\n')
+        count += 1
 
-        if device in devices.keys():
-            # input is device name
-            deviceid = devices.get(device).get('id')
-        else:
-            # check if input is device id
-            deviceid_matches = list(filter(lambda d: d.get('id') == device, devices))
-            if len(deviceid_matches) > 0:
-                deviceid = deviceid_matches[0]
+    sys.stdout.flush()
 
-        return deviceid
+    return count
 
-    def _recentlyPlayed(self, limit=20, before=None, after=None):
-        url = self.apiurl + '/me/player/recently-played'
+def printCurrentlyPlaying(data, showimg=False, asJson=False, render='auto'):
+    if asJson:
+        printJson(data, flush=True)
 
+        if data.get('status') != 'success':
+            raise Exception(data.get('error'))
+    elif data.get('status', 'erorr') == 'success':
+        if showimg is True:
+            showImage(data.get('artwork'), data.get('artwork_data'), mode=render)
+
+        msg = 'Now Playing:\n'
+        msg += 'Track: {}\n'.format(data.get('track'))
+        msg += 'Artist: {}\n'.format(data.get('artist'))
+        msg += 'Album: {}\n'.format(data.get('album'))
+        if data.get('playlist', None) is not None:
+            msg += 'Playlist: {}\n'.format(data.get('playlist'))
+
+        msg += 'URI: {}\n'.format(data.get('uri'))
+
+        if data.get('playlist_uri', None) is not None:
+            msg += 'Playlist URI: {}\n'.format(data.get('playlist_uri'))
+
+        print(msg)
+    else:
+        raise Exception(data.get('error'))
+
+def printControlPlayback(data, asJson=False):
+    if asJson:
+        printJson(data)
+        return
+
+    print(data.get('status'), data.get('status_code'), data.get('error', None))
+
+def printPlaylistResults(data, asJson=False):
+    if asJson:
+        printJson(data)
+        return
+
+    print(data.get('status'), data.get('snapshot_id', None))
+
+    for batch in data.get('batches', []):
+        if batch.get('status') != 'success':
+            print('batch {}: {} {} {}'.format(batch.get('batch'), batch.get('status'), batch.get('status_code'), batch.get('error')))
+
+def printBatchResult(command, data, asJson=False):
+    if asJson:
+        printJson(dict(data, line=command.get('line'), command=command.get('text')), flush=True)
+    else:
+        details = filter(lambda d: d is not None, (data.get('status'), data.get('status_code', data.get('snapshot_id')), data.get('error')))
+        print('{}: {} -> {}'.format(command.get('line'), command.get('text'), ' '.join(map(str, details))), flush=True)
+
+def printFindResults(matches, asJson=False):
+    if asJson:
+        streamJson(matches)
+        return
+
+    for match in matches:
+        print('\'{}\' by \'{}\' - \'{}\' at position {}'.format(match.get('track'), match.get('artist'), match.get('playlist'), match.get('position')))
+
+    print('{} matches in {} playlists'.format(len(matches), len(set(map(lambda m: m.get('playlist_id'), matches)))))
+
+def printSyncResults(data, asJson=False):
+    if asJson:
+        printJson(data)
+        return
+
+    for op in data.get('plan', []) if data.get('dry_run') else []:
+        if op.get('op') == 'remove':
+            print('remove {} tracks'.format(len(op.get('uris'))))
+        elif op.get('op') == 'move':
+            print('move {} tracks from {} to {}'.format(op.get('range_length'), op.get('range_start'), op.get('insert_before')))
+        else:
+            print('add {} tracks at {}'.format(len(op.get('uris')), op.get('position')))
+
+    print('{} {}'.format(data.get('status'), data.get('snapshot_id')))
+    print('{} {} removed, {} moved, {} added in {} requests'.format('Would have' if data.get('dry_run') else 'Done:', data.get('removed'), data.get('moved'), data.get('added'), len(data.get('plan'))))
+
+    for batch in data.get('batches', []):
+        if batch.get('status') != 'success':
+            print('{} batch {}: {} {} {}'.format(batch.get('op'), batch.get('batch'), batch.get('status'), batch.get('status_code'), batch.get('error')))
+
+    if data.get('skipped', 0) > 0:
+        print('{} later steps were not attempted'.format(data.get('skipped')))
+
+def printDevices(data, asJson=False):
+    if asJson:
+        streamJson(data.values())
+        return
+
+    print(dict(map(lambda d: (d[0], d[1].raw if d[1].raw is not None else d[1].toDict()), data.items())))
+
+def printRecents(data, asJson=False):
+    if asJson:
+        streamJson(data)
+        return
+
+    for song in data:
+        print('\'{}\' by \'{}\' - \'{}\''.format(song.get('track'), song.get('artist'), song.get('album')))
+
+def printPlaylists(playlists, asJson=False):
+    if asJson:
+        return streamJson(playlists)
+
+    count = 0
+    for playlist in playlists:
+        print('\'{}\' - {} tracks - {}'.format(playlist.name, playlist.tracks_total, playlist.uri))
+        count += 1
+
+    return count
+
+def printTracks(tracks, asJson=False):
+    if asJson:
+        return streamJson(tracks)
+
+    count = 0
+    for position, track in enumerate(tracks):
+        print('{}: \'{}\' by \'{}\' - \'{}\''.format(position, track.name, track.artist, track.album))
+        count += 1
+
+    return count
+
+def requestParams(params):
+    # requests leaves out None values, httpx would send them empty
+    if not params:
+        return params
+
+    return dict(filter(lambda p: p[1] is not None, params.items()))
+
+class SpotifyBase:
+    # everything Spotify and AsyncSpotify share that does no I/O of its own
+    VALID_OPERATIONS = {
+        'playback': ['play', 'pause', 'next', 'previous', 'shuffle', 'repeat', 'queue', 'seek'],
+        'playlist': ['add', 'remove']
+    }
+
+    # refresh this many seconds before Spotify would reject the token
+    TOKEN_EXPIRY_MARGIN = 60
+
+    # seconds a cached response stays fresh, per kind of resource
+    CACHE_TTLS = {
+        'user': 3600,
+        'playlists': 300,
+        'playlist': 300,
+        'devices': 10
+    }
+
+    def _setup(self, application_token, refresh_token, client_id=None, tokenfile=None, cache=None, scheduler=None, retries=3, keepRaw=False, apiurl=None, accountsurl=None, rateLimit=RATE_LIMIT):
+        self.apiurl = apiurl if apiurl is not None else API_URL
+        self.accountsurl = accountsurl if accountsurl is not None else ACCOUNTS_URL
+
+        self.app_token = application_token
+        self.refresh_token = refresh_token
+        self.client_id = client_id
+
+        # newest refresh token handed out since the configured one, if they rotate
+        self.rotated_token = None
+
+        self.tokenfile = tokenfile
+        self.access_token = None
+        self.expires_at = 0
+        self.headers = {}
+
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler(limit=rateLimit, retries=retries)
+
+        # a RequestProfiler here records every call _request makes, per command like the memo
+        self.activeProfiler = contextvars.ContextVar('profiler', default=None)
+
+        self.cache = cache if cache is not None else TTLCache()
+
+        # parsed models drop the API payload unless a caller needs it
+        self.keepRaw = keepRaw
+
+    @property
+    def profiler(self):
+        return self.activeProfiler.get()
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self.activeProfiler.set(profiler)
+
+    def _cachedToken(self, force=False):
+        if not force and self.access_token is not None and time.time() < self.expires_at - self.TOKEN_EXPIRY_MARGIN:
+            return self.access_token
+
+        cached = None
+        if self.tokenfile is not None:
+            cached = readTokenCache(self.tokenfile, self.refresh_token)
+
+        if cached is not None and cached.get('refresh_token'):
+            self.rotated_token = cached.get('refresh_token')
+
+        if not force and cached is not None and time.time() < cached['expires_at'] - self.TOKEN_EXPIRY_MARGIN:
+            self._setAccessToken(cached['access_token'], cached['expires_at'])
+            return self.access_token
+
+        return None
+
+    def _storeToken(self, data):
+        if data.get('access_token') is None:
+            return None
+
+        if data.get('refresh_token') and data.get('refresh_token') != self.refresh_token:
+            self.rotated_token = data.get('refresh_token')
+
+        self._setAccessToken(data.get('access_token'), time.time() + data.get('expires_in', 3600))
+
+        if self.tokenfile is not None:
+            writeTokenCache(self.tokenfile, self.refresh_token, self.access_token, self.expires_at, rotated_token=self.rotated_token)
+
+        return self.access_token
+
+    def _setAccessToken(self, access_token, expires_at):
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.headers = {'Authorization': 'Bearer {}'.format(self.access_token)}
+
+    def _tokenRequest(self):
+        return refreshRequest(self.app_token, self.client_id, self.rotated_token or self.refresh_token)
+
+    def _cacheLookup(self, method, url, resource=None, params=None, fresh=False):
+        extra_headers = {}
+
+        if resource is None or method != 'GET':
+            return None, None, None, extra_headers
+
+        key = cacheKey(method, url, params)
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            # fresh asks the API even within the TTL, an ETag still saves the body
+            if time.time() < entry.get('expires', 0) and not fresh:
+                return key, entry, CachedResponse(entry), extra_headers
+            elif entry.get('etag'):
+                extra_headers['If-None-Match'] = entry.get('etag')
+
+        return key, entry, None, extra_headers
+
+    def _cacheStore(self, key, entry, resource, res):
+        if key is None:
+            return res, None
+
+        ttl = self.CACHE_TTLS.get(resource, 0)
+
+        if res.status_code == 304 and entry is not None:
+            # unchanged since we cached it, only the freshness moves
+            entry = dict(entry, expires=time.time() + ttl)
+            self.cache.set(key, entry)
+            return CachedResponse(entry), 'revalidated'
+        elif res.status_code == 200:
+            self.cache.set(key, {'status_code': res.status_code, 'body': res.text, 'etag': res.headers.get('ETag'), 'expires': time.time() + ttl})
+
+        return res, 'miss'
+
+    def _record(self, method, url, res, cache, start, timings=None):
+        # a shared response's retries were already counted against the call that made it
+        raw_retries = getattr(getattr(res, 'raw', None), 'retries', None) if cache != 'coalesced' else None
+        body = getattr(res, 'content', None)
+
+        self.profiler.record(
+            timestamp=time.time(),
+            method=method,
+            endpoint=endpointName(url),
+            status=res.status_code,
+            bytes=len(body) if body is not None else len(res.text or ''),
+            cache=cache,
+            retries=(getattr(res, 'retries', 0) if cache != 'coalesced' else 0) + (len(getattr(raw_retries, 'history', ())) if raw_retries is not None else 0),
+            dns=timings['dns'] if timings is not None else 0.0,
+            connect=timings['connect'] if timings is not None else 0.0,
+            tls=timings['tls'] if timings is not None else 0.0,
+            total=time.perf_counter() - start,
+            caller=self._caller()
+        )
+
+    def _caller(self):
+        chain = []
+
+        # client methods still on the stack, outermost first
+        frame = sys._getframe(1)
+        while frame is not None:
+            name = frame.f_code.co_name
+            if name not in ('_request', '_coalesced', '_send', '_fetch', '_getJson', '_record', '_caller') and not name.startswith('<') and frame.f_locals.get('self') is self:
+                chain.append(name)
+
+            frame = frame.f_back
+
+        return ' > '.join(reversed(chain)) or None
+
+    def _jsonResult(self, res):
+        data = {'status_code': res.status_code}
+        if res.status_code == 200:
+            data['status'] = 'success'
+            data.update(res.json())
+        else:
+            data['status'] = 'error'
+
+        print(data, file=VERBOSE_STDOUT, flush=True)
+
+        return data
+
+    def _recentParams(self, limit=20, before=None, after=None):
         params = {}
         if limit in range(1, 51):
             params['limit'] = limit
@@ -461,176 +1709,1751 @@ class Spotify:
         elif after and before is None:
             params['after'] = after
 
-        res = requests.get(url, headers=self.headers, params=params)
+        return params
+
+    def _playbackOperation(self, operation):
+        operation = operation.lower() if operation is not None else None
+        if operation not in self.VALID_OPERATIONS['playback']:
+            raise Exception('Invalid playback operation!')
+
+        return operation
+
+    def _playbackRequest(self, operation, deviceid=None, uri=None, seekOffset=0, playback=None, song=None):
+        params = {}
+
+        # an unknown device is left out, the API then uses the active one
+        if deviceid is not None:
+            params['device_id'] = deviceid
+
+        if operation == 'shuffle':
+            params['state'] = not playback.shuffle_state
+        elif operation == 'repeat':
+            params['state'] = 'context' if playback.repeat_state == 'off' else 'off'
+        elif operation == 'queue':
+            params['uri'] = uri
+        elif operation == 'seek':
+            duration = int(song.duration_ms)
+            params['position_ms'] = round(duration * (seekOffset/4))
+
+        method = 'POST' if operation == 'queue' else 'PUT'
 
+        return method, self.apiurl + '/me/player/{}'.format(operation), requestParams(params)
+
+    def _playbackResult(self, operation, res):
         data = {'status_code': res.status_code}
-        if res.status_code == 200:
+        if res.status_code == 204:
             data['status'] = 'success'
-
-            data.update(res.json())
         else:
             data['status'] = 'error'
 
+            if res.status_code == 404:
+                data['error'] = 'device not found'
+            elif res.status_code == 403:
+                data['error'] = 'unable to perform operation: {}'.format(operation)
+            elif res.status_code == 429:
+                data['error'] = 'rate limited'
+            else:
+                data['error'] = 'undocumented error'
+
         print(data, file=VERBOSE_STDOUT, flush=True)
 
         return data
 
-    def _getSongData(self, song_obj):
-        context = song_obj.get('context', {})
-        if context and context.get('type') == 'playlist':
-            playlist_data = self.getPlaylist(song_obj.get('context', {}).get('href').split('/')[-1])
-            playlist = playlist_data.get('name')
-            playlist_uri = playlist_data.get('uri')
+    def _deviceMap(self, data):
+        if data.get('status') == 'success':
+            return dict(map(lambda d: (d.name, d), map(Device.fromJson, data.get('devices'))))
         else:
-            playlist = None
-            playlist_uri = None
-        if 'item' in song_obj:
-            song = song_obj.get('item', {})
-        elif 'track' in song_obj:
-            song = song_obj.get('track', {})
+            raise Exception('Unable to retrieve devices')
 
-        images = song.get('album', {}).get('images', [{}])
-        imgurl = images[1].get('url')
+    def _deviceId(self, devices, device):
+        if device in devices.keys():
+            # input is device name
+            return devices.get(device).id
 
-        track = song.get('name')
-        artist = ', '.join(list(map(lambda x: x.get('name'), song.get('artists', [{}]))))
-        album = song.get('album', {}).get('name')
-        uri = song.get('uri')
+        # check if input is device id
+        deviceid_matches = list(filter(lambda d: d.id == device, devices.values()))
+        if len(deviceid_matches) > 0:
+            return deviceid_matches[0].id
 
-        return {'status': 'success', 'artwork': imgurl, 'track': track, 'artist': artist, 'album': album, 'uri': uri, 'playlist': playlist, 'playlist_uri': playlist_uri, 'raw': song}
+        return None
 
-    def getRecentlyPlayed(self, limit=20, before=None, after=None):
-        data = self._recentlyPlayed(limit=limit, before=before, after=after) 
+class Spotify(SpotifyBase):
+    # the Web API accepts at most this many uris per playlist mutation
+    PLAYLIST_BATCH_SIZE = 100
 
-        return list(map(lambda s: self._getSongData(s), data['items']))
-    
-    def __repr__(self):
-        connected_user = self.getCurrentUser()
-        user = connected_user.get('display_name', connected_user.get('error'))
-        status = connected_user.get('status')
-        profile = connected_user.get('images', []).pop().get('url')
+    def __init__(self, application_token, refresh_token, session=None, pool_size=10, timeout=(3.05, 10), retries=3, tokenfile=None, cache=None, workers=4, keepRaw=False, scheduler=None, apiurl=None, accountsurl=None, client_id=None, coalesce=True, rateLimit=RATE_LIMIT):
+        self._setup(application_token, refresh_token, client_id=client_id, tokenfile=tokenfile, cache=cache, scheduler=scheduler, retries=retries, keepRaw=keepRaw, apiurl=apiurl, accountsurl=accountsurl,
+                    rateLimit=rateLimit)
 
-        showImage(profile)
+        # one keep-alive pool shared by every call this client makes
+        self.session = session if session is not None else createSession(pool_size=pool_size, retries=retries)
+        self.timeout = timeout
+        self.workers = workers
 
-        return '<Spotify (\'{}\' - {})>'.format(user, status)
+        # identical GETs share one response while in flight, and for the rest of a command
+        self.flights = SingleFlight() if coalesce else None
 
-if __name__ == "__main__":
-    parser = argparsejson.parse_arguments(os.path.join(SCRIPT_DIR, "commands.json"), prog=__file__)
-    args = parser.parse_args()
+        # thread pools share one client, only one of them may refresh the token
+        self.tokenLock = threading.Lock()
 
-    if args.verbose:
-        VERBOSE_STDOUT = sys.stdout
-    else:
-        VERBOSE_STDOUT = open(os.devnull, 'w')
+        self.playlistIndex = None
+        self.playlistIndexExpires = 0
 
-    print(args, file=VERBOSE_STDOUT, flush=True)
+    def _request(self, method, url, resource=None, priority='interactive', coalesce=True, memo=True, **kwargs):
+        if 'params' in kwargs:
+            kwargs['params'] = requestParams(kwargs.get('params'))
 
-    if args.mode is None:
-        parser.print_help()
-    elif args.mode == 'setup':
-        if args.clientid:
-            clientid = args.clientid
+        if self.profiler is None:
+            return self._coalesced(method, url, resource, priority, coalesce, memo=memo, **kwargs)[0]
 
-        if args.clientsecret:
-            clientsecret = args.clientsecret
+        timings = connectionTimings(reset=True)
+        start = time.perf_counter()
 
-        setupSpotify(clientid, clientsecret)
-    else:
-        config = parse_config()
+        res, cache = self._coalesced(method, url, resource, priority, coalesce, memo=memo, **kwargs)
+        self._record(method, url, res, cache, start, timings)
 
-        app_token = config.get('app_token')
-        refresh_token = config.get('refresh_token')
+        return res
 
-        client = Spotify(app_token, refresh_token)
+    def _coalesced(self, method, url, resource=None, priority='interactive', coalesce=True, memo=True, **kwargs):
+        if self.flights is None or 'headers' in kwargs:
+            return self._fetch(method, url, resource, priority, **kwargs)
 
-        if args.mode == 'status':
-            if args.showimg:
-                showimg = args.showimg
-            else:
-                showimg = False
+        if method != 'GET':
+            self.flights.forget()
+            return self._fetch(method, url, resource, priority, **kwargs)
 
-            printCurrentlyPlaying(client.currentlyPlaying(), showimg)
+        if not coalesce:
+            return self._fetch(method, url, resource, priority, **kwargs)
 
-        elif args.mode == 'playback':
-            if args.playback:
-                operation = args.playback
-            else:
-                operation = None
+        result, shared = self.flights.do(cacheKey(method, url, kwargs.get('params')), lambda: self._fetch(method, url, resource, priority, **kwargs), memo=memo)
 
-            if args.device:
-                device = args.device
-            else:
-                device = None
+        return (result[0], 'coalesced') if shared else result
 
-            if operation == "queue" and args.uri:
-                uri = args.uri
-            else:
-                uri = None
+    def coalesceScope(self):
+        if self.flights is None:
+            return contextlib.nullcontext()
 
-            if operation == "seek":
-                seek = args.duration
-            else:
-                seek = 0
+        return self.flights.scope()
 
-            status = client.controlPlayback(operation, device=device, uri=uri, seekOffset=seek)
-            printControlPlayback(status)
+    def _fetch(self, method, url, resource=None, priority='interactive', fresh=False, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
 
-        elif args.mode == 'playlist':
-            print(args)
-            if args.operation:
-                operation = args.operation
-            else:
-                operation = None
+        if 'headers' in kwargs:
+            return self.session.request(method, url, **kwargs), None
 
-            if args.nowplaying:
-                nowplaying = args.nowplaying
-            else:
-                nowplaying = False
+        key, entry, hit, extra_headers = self._cacheLookup(method, url, resource, kwargs.get('params'), fresh)
+        if hit is not None:
+            return hit, 'hit'
 
-            if args.playlist:
-                playlist = args.playlist
-            else:
-                playlist = None
+        res = self._send(method, url, extra_headers, priority=priority, **kwargs)
 
-            if args.song:
-                song = args.song
-            elif nowplaying is True:
-                song = client.currentlyPlaying().get('uri')
-            else:
-                song = None
+        return self._cacheStore(key, entry, resource, res)
 
-            if args.device:
-                device = args.device
-            else:
-                device = None
+    def _send(self, method, url, extra_headers, priority='interactive', **kwargs):
+        refresh = False
+        refreshed = False
+        attempt = 0
+        token = None
 
-            results = client.playlist(operation, playlist, [song], device=device)
+        while True:
+            token = self.get_access_token(force=refresh, rejected=token)
+            self.scheduler.acquire(priority)
+            res = self.session.request(method, url, headers=dict(extra_headers, Authorization='Bearer {}'.format(token)), **kwargs)
 
-        elif args.mode == 'devices':
-            devices = client.getDevices()
-            printDevices(devices)
+            res.retries = attempt + int(refreshed)
 
-        elif args.mode == 'user':
-            if args.user == 'recents':
-                if args.before:
-                    before = args.before
-                else:
-                    before = None
+            refresh = res.status_code == 401 and not refreshed
+            if refresh:
+                # token was revoked or expired early, refresh once and replay
+                refreshed = True
+                continue
 
-                if args.after:
-                    after = args.after
-                else:
-                    after = None
+            if res.status_code != 429 or attempt >= self.scheduler.retries:
+                return res
 
-                if args.limit:
-                    limit = args.limit
-                else:
-                    limit = None
+            delay = self.scheduler.throttled(res.headers.get('Retry-After'), attempt)
+            if delay is None:
+                return res
 
-                recents = client.getRecentlyPlayed(limit=limit, before=before, after=after)
-                printRecents(recents)
-            elif args.user == 'status':
-                print(client)
+            print('Rate limited, retrying {} {} in {}s'.format(method, url, delay), file=VERBOSE_STDOUT, flush=True)
+            attempt += 1
+
+    def _invalidate(self, url):
+        self.cache.invalidate(cacheKey('GET', url))
+
+    def close(self):
+        self.cache.close()
+        self.session.close()
+
+    def request_token(self):
+        headers, payload = self._tokenRequest()
+
+        res = self._request('POST', self.accountsurl + '/api/token', headers=headers, data=payload)
+        if res.status_code != 200:
+            print(res.json(), file=VERBOSE_STDOUT, flush=True)
+
+        return res.json()
+
+    def get_access_token(self, force=False, rejected=None):
+        with self.tokenLock:
+            # another thread may have replaced the rejected token while this one waited
+            if force and rejected is not None and self.access_token != rejected:
+                force = False
+
+            token = self._cachedToken(force)
+            if token is not None:
+                return token
+
+            return self._storeToken(self.request_token())
+
+    def getCurrentUser(self):
+        url = self.apiurl + '/me'
+
+        res = self._request('GET', url, resource='user')
+        print(res.json(), file=VERBOSE_STDOUT, flush=True)
+        data = res.json()
+
+        if res.status_code == 200:
+            data['status'] = 'connected'
+        else:
+            data['status'] = 'disconnected'
+
+        return data
+
+    def playlist(self, operation, playlist, songs, device=None):
+        if operation not in self.VALID_OPERATIONS.get('playlist'):
+            raise Exception('Invalid playlist operation!')
+
+        playlistid = self.resolvePlaylist(playlist)
+
+        if playlistid is None:
+            raise Exception('Invalid playlist name or id!')
+
+        if operation == 'add':
+            return self.addToPlaylist(playlistid, songs)
+        elif operation == 'remove':
+            return self.removeFromPlaylist(playlistid, songs, device=device)
+
+    def getPlaylistIndex(self, refresh=False):
+        key = 'INDEX playlists'
+
+        if self.playlistIndex is None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.playlistIndex = PlaylistIndex.fromDict(json.loads(entry.get('body')))
+                self.playlistIndexExpires = entry.get('expires', 0)
+
+        if self.playlistIndex is None or refresh is True or time.time() >= self.playlistIndexExpires:
+            if self.playlistIndex is None:
+                self.playlistIndex = PlaylistIndex()
+
+            # unchanged snapshots keep their existing index entries
+            self.playlistIndex.update(self.iterPlaylists(fresh=refresh))
+            self.playlistIndexExpires = time.time() + self.CACHE_TTLS.get('playlists', 0)
+
+            self.cache.set(key, {'body': json.dumps(self.playlistIndex.toDict()), 'expires': self.playlistIndexExpires})
+
+        return self.playlistIndex
+
+    def resolvePlaylist(self, playlist):
+        index = self.getPlaylistIndex()
+        playlistid = index.resolve(playlist)
+
+        if playlistid is None:
+            # the playlist may be newer than the cached index
+            playlistid = self.getPlaylistIndex(refresh=True).resolve(playlist)
+
+        return playlistid
+
+    # largest page sizes the Web API accepts for each listing
+    PAGE_LIMITS = {
+        'playlists': 50,
+        'tracks': 100
+    }
+
+    def _paginate(self, url, params=None, resource=None, priority='bulk', fresh=False):
+        while url is not None:
+            # a response saved earlier in the command would be just as stale as the cache,
+            # and keeping every page until the command ends would undo the streaming
+            res = self._request('GET', url, resource=resource, priority=priority, params=params, fresh=fresh, coalesce=not fresh, memo=False)
+            if res.status_code != 200:
+                raise Exception('Unable to retrieve {} ({})'.format(url, res.status_code))
+
+            page = res.json()
+            print(page, file=VERBOSE_STDOUT, flush=True)
+
+            yield from page.get('items', [])
+
+            # the next link already carries offset and limit
+            url = page.get('next')
+            params = None
+
+    def iterPlaylists(self, fresh=False):
+        url = self.apiurl + '/me/playlists'
+
+        return map(Playlist.fromJson, self._paginate(url, params={'limit': self.PAGE_LIMITS['playlists']}, resource='playlists', fresh=fresh))
+
+    def iterPlaylistTracks(self, id):
+        url = self.apiurl + '/playlists/{}/tracks'.format(id)
+
+        return map(lambda item: Track.fromJson(item, keepRaw=self.keepRaw), self._paginate(url, params={'limit': self.PAGE_LIMITS['tracks']}))
+
+    def getPlaylists(self):
+        data = {'status': 'success', 'items': list(self.iterPlaylists())}
+        data['total'] = len(data['items'])
+
+        print(data, file=VERBOSE_STDOUT, flush=True)
+
+        return data
+
+    def getPlaylist(self, id, alltracks=False, fields=None):
+        url = self.apiurl + '/playlists/{}'.format(id)
+
+        res = self._request('GET', url, resource='playlist', params={'fields': fields})
+        data = self._jsonResult(res)
+
+        tracks = data.get('tracks', {})
+        if alltracks is True and tracks.get('next') is not None:
+            # continue from the page embedded in the playlist object
+            tracks['items'] += list(self._paginate(tracks.get('next')))
+            tracks['next'] = None
+
+        return data
+
+    def addToPlaylist(self, playlistid, songids, position=None):
+        url = self.apiurl + '/playlists/{}/tracks'.format(playlistid)
+
+        batches = []
+
+        # inserts land in request order, so batches go out one after another
+        for idx, batch in enumerate(chunked(songids, self.PLAYLIST_BATCH_SIZE)):
+            payload = {'uris': batch}
+            if position is not None:
+                payload['position'] = position + idx * self.PLAYLIST_BATCH_SIZE
+
+            res = self._request('POST', url, priority='bulk', json=payload)
+            batches.append(self._batchResult(idx, batch, res, 201))
+
+        self._invalidatePlaylist(playlistid)
+
+        return self._batchSummary(batches)
+
+    def removeFromPlaylist(self, playlistid, songids, device=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        url = self.apiurl + '/playlists/{}/tracks'.format(playlistid)
+        print(url, file=VERBOSE_STDOUT, flush=True)
+
+        def remove(idx, batch):
+            payload = {'tracks': list({'uri': songid} for songid in batch)}
+            print(payload, file=VERBOSE_STDOUT, flush=True)
+
+            res = self._request('DELETE', url, priority='bulk', json=payload)
+            return self._batchResult(idx, batch, res, 200)
+
+        # removal by uri does not depend on order, so batches run side by side
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(inContext(remove), idx, batch) for idx, batch in enumerate(chunked(dict.fromkeys(songids), self.PLAYLIST_BATCH_SIZE))]
+            batches = [future.result() for future in futures]
+
+        self._invalidatePlaylist(playlistid)
+
+        data = self._batchSummary(batches)
+
+        if device is not None:
+            self.controlPlayback('next', device=device)
+
+        return data
+
+    def syncPlaylist(self, playlistid, uris, dryRun=False, known=None):
+        url = self.apiurl + '/playlists/{}'.format(playlistid)
+
+        res = self._request('GET', url, params={'fields': 'snapshot_id'})
+        if res.status_code != 200:
+            raise Exception('Unable to retrieve playlist {} ({})'.format(playlistid, res.status_code))
+
+        snapshot_id = res.json().get('snapshot_id')
+
+        # known(snapshot_id) can hand back the contents without paging through them again
+        current = known(snapshot_id) if known is not None else None
+        if current is None:
+            current = list(map(lambda t: t.uri, self.iterPlaylistTracks(playlistid)))
+
+        plan = planPlaylistSync(current, uris, batchSize=self.PLAYLIST_BATCH_SIZE)
+
+        counts = {'removed': 0, 'moved': 0, 'added': 0}
+        for op in plan:
+            counts[{'remove': 'removed', 'move': 'moved', 'add': 'added'}[op.get('op')]] += len(op.get('uris'))
+
+        data = dict(counts, status='success', snapshot_id=snapshot_id, plan=plan, batches=[], dry_run=dryRun)
+        if dryRun or len(plan) == 0:
+            return data
+
+        batches = []
+        latest = snapshot_id
+
+        for idx, op in enumerate(plan):
+            if op.get('op') == 'remove':
+                # positions refer to the snapshot the diff was made against
+                res = self._request('DELETE', url + '/tracks', priority='bulk', json={'tracks': op.get('tracks'), 'snapshot_id': snapshot_id})
+                batch = self._batchResult(idx, op.get('uris'), res, 200)
+            elif op.get('op') == 'move':
+                payload = {'range_start': op.get('range_start'), 'range_length': op.get('range_length'), 'insert_before': op.get('insert_before'), 'snapshot_id': latest}
+                res = self._request('PUT', url + '/tracks', priority='bulk', json=payload)
+                batch = self._batchResult(idx, op.get('uris'), res, 200)
+            else:
+                res = self._request('POST', url + '/tracks', priority='bulk', json={'uris': op.get('uris'), 'position': op.get('position')})
+                batch = self._batchResult(idx, op.get('uris'), res, 201)
+
+            batch['op'] = op.get('op')
+            batches.append(batch)
+
+            # every later step was planned against the playlist this one would have left
+            if batch.get('status') != 'success':
+                break
+
+            latest = batch.get('snapshot_id')
+
+        self._invalidatePlaylist(playlistid)
+
+        data.update(self._batchSummary(batches))
+        data['skipped'] = len(plan) - len(batches)
+        if data['skipped'] > 0 and data['status'] == 'success':
+            data['status'] = 'partial'
+
+        return data
+
+    def _batchResult(self, idx, batch, res, expected_status):
+        data = {'batch': idx, 'count': len(batch), 'status_code': res.status_code}
+
+        if res.status_code == expected_status:
+            data['status'] = 'success'
+            data['snapshot_id'] = res.json().get('snapshot_id')
+        else:
+            data['status'] = 'error'
+            try:
+                data['error'] = res.json().get('error', {}).get('message')
+            except ValueError:
+                data['error'] = 'undocumented error'
+
+        print(data, file=VERBOSE_STDOUT, flush=True)
+
+        return data
+
+    def _batchSummary(self, batches):
+        failed = list(filter(lambda b: b.get('status') != 'success', batches))
+        succeeded = list(filter(lambda b: b.get('status') == 'success', batches))
+
+        if len(failed) == 0:
+            status = 'success'
+        elif len(succeeded) == 0:
+            status = 'error'
+        else:
+            status = 'partial'
+
+        data = {'status': status, 'batches': batches, 'failed': len(failed)}
+        if len(succeeded) > 0:
+            data['snapshot_id'] = succeeded[-1].get('snapshot_id')
+
+        return data
+
+    def _invalidatePlaylist(self, playlistid):
+        self._invalidate(self.apiurl + '/playlists/{}'.format(playlistid))
+        self._invalidate(self.apiurl + '/me/playlists')
+
+    def currentlyPlaying(self):
+        url = self.apiurl + '/me/player/currently-playing'
+
+        res = self._request('GET', url)
+        print(res.status_code, file=VERBOSE_STDOUT, flush=True)
+        if res.status_code == 200:
+            data = res.json()
+
+            print(data, file=VERBOSE_STDOUT, flush=True)
+
+            return self._getSongData(data)
+        elif res.status_code == 204:
+            return {'status': 'error', 'error': 'No track currently playing'}
+
+    def getPlayback(self):
+        url = self.apiurl + '/me/player'
+
+        res = self._request('GET', url)
+
+        if res.status_code == 200:
+            data = res.json()
+            print(data, file=VERBOSE_STDOUT, flush=True)
+
+            return PlaybackState.fromJson(data, status_code=res.status_code, keepRaw=self.keepRaw)
+
+        print(res.status_code, file=VERBOSE_STDOUT, flush=True)
+
+        return PlaybackState(status='error', status_code=res.status_code)
+
+    def watchPlayback(self, maxInterval=30, minInterval=1):
+        playlists = {}
+        last = None
+
+        while True:
+            playback = self.getPlayback()
+            item = playback.item if playback.status == 'success' else None
+
+            if item is not None:
+                current = (item.uri, playback.context_uri)
+
+                if current != last:
+                    last = current
+
+                    # playlist names barely change, keep them for the whole watch
+                    playlistid = playback.playlistId()
+                    if playlistid is not None and playlistid not in playlists:
+                        playlists[playlistid] = self.getPlaylist(playlistid, fields=PLAYLIST_CONTEXT_FIELDS)
+
+                    item.setPlaylist(playlists.get(playlistid))
+
+                    yield item
+
+                remaining = ((item.duration_ms or 0) - (playback.progress_ms or 0)) / 1000
+
+                # wake up just after the track should end, but catch skips eventually
+                if playback.is_playing:
+                    interval = min(max(remaining + 0.5, minInterval), maxInterval)
+                else:
+                    interval = maxInterval
+            else:
+                if last is not None:
+                    last = None
+                    yield {'status': 'error', 'error': 'No track currently playing'}
+
+                interval = maxInterval
+
+            time.sleep(interval)
+
+    def controlPlayback(self, operation, device=None, uri=None, seekOffset=0, deviceid=None):
+        operation = self._playbackOperation(operation)
+
+        # callers running many operations resolve the device once and pass its id
+        if deviceid is None and device:
+            deviceid = self._getDeviceId(device)
+
+        playback = self.getPlayback() if operation in ('shuffle', 'repeat') else None
+        song = self.currentlyPlaying() if operation == 'seek' else None
+
+        method, url, params = self._playbackRequest(operation, deviceid, uri, seekOffset, playback, song)
+
+        return self._playbackResult(operation, self._request(method, url, params=params))
+
+    def batch(self, commands, device=None):
+        from concurrent.futures import Future, ThreadPoolExecutor
+
+        deviceid = None
+        if device:
+            deviceid = self._getDeviceId(device)
+            if deviceid is None:
+                raise Exception('Invalid device name or id!')
+
+        lanes = OrderedDict()
+        results = []
+
+        for command in commands:
+            future = Future()
+            results.append((command, future))
+
+            if command.get('error') is not None:
+                future.set_result({'status': 'error', 'error': command.get('error')})
+                continue
+
+            try:
+                lane = self._batchLane(command)
+            except Exception as e:
+                future.set_result({'status': 'error', 'error': str(e)})
+                continue
+
+            steps = lanes.setdefault(lane, [])
+
+            # back to back adds to one playlist go out as a single batched add
+            if command.get('operation') == 'add' and len(steps) > 0 and steps[-1][0].get('operation') == 'add':
+                steps[-1][0]['songs'] += command.get('songs')
+                steps[-1][1].append(future)
+            else:
+                steps.append((dict(command, songs=list(command.get('songs', []))), [future]))
+
+        # the player is one lane and each playlist another, every lane keeps its
+        # own order but lanes do not wait for each other
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for steps in lanes.values():
+                executor.submit(inContext(self._runLane), steps, deviceid)
+
+            for command, future in results:
+                yield command, future.result()
+
+    def _batchLane(self, command):
+        if command.get('op') == 'playlist':
+            if command.get('operation') not in self.VALID_OPERATIONS['playlist']:
+                raise Exception('Invalid playlist operation!')
+
+            playlistid = self.resolvePlaylist(command.get('playlist'))
+            if playlistid is None:
+                raise Exception('Invalid playlist name or id!')
+
+            command['playlistid'] = playlistid
+
+            return ('playlist', playlistid)
+        elif command.get('op') in self.VALID_OPERATIONS['playback']:
+            return ('player',)
+
+        raise Exception('Invalid batch operation: {}'.format(command.get('op')))
+
+    def _runLane(self, steps, deviceid=None):
+        for command, futures in steps:
+            try:
+                if command.get('op') == 'playlist' and command.get('operation') == 'add':
+                    result = self.addToPlaylist(command.get('playlistid'), command.get('songs'))
+                elif command.get('op') == 'playlist':
+                    result = self.removeFromPlaylist(command.get('playlistid'), command.get('songs'))
+                else:
+                    result = self.controlPlayback(command.get('op'), uri=command.get('uri'), seekOffset=command.get('duration', 0), deviceid=deviceid)
+            except Exception as e:
+                result = {'status': 'error', 'error': str(e)}
+
+            for future in futures:
+                future.set_result(result)
+
+    def _getDevices(self):
+        url = self.apiurl + '/me/player/devices'
+
+        return self._jsonResult(self._request('GET', url, resource='devices'))
+
+    def getDevices(self):
+        return self._deviceMap(self._getDevices())
+
+    def _getDeviceId(self, device):
+        return self._deviceId(self.getDevices(), device)
+
+    def _recentlyPlayed(self, limit=20, before=None, after=None, priority='interactive'):
+        url = self.apiurl + '/me/player/recently-played'
+
+        # history syncs page through plays in bulk, those pages are not kept either
+        return self._jsonResult(self._request('GET', url, priority=priority, params=self._recentParams(limit, before, after), memo=priority != 'bulk'))
+
+    def _getSongData(self, song_obj):
+        playlistid = playlistContextId(song_obj)
+        if playlistid is not None:
+            # only the name and uri are shown, the full playlist would carry its first 100 tracks
+            playlist_data = self.getPlaylist(playlistid, fields=PLAYLIST_CONTEXT_FIELDS)
+        else:
+            playlist_data = None
+
+        return songData(song_obj, playlist_data, keepRaw=self.keepRaw)
+
+    def getRecentlyPlayed(self, limit=20, before=None, after=None):
+        data = self._recentlyPlayed(limit=limit, before=before, after=after) 
+
+        return list(map(lambda s: self._getSongData(s), data['items']))
+    
+    def __repr__(self):
+        connected_user = self.getCurrentUser()
+        user = connected_user.get('display_name', connected_user.get('error'))
+        status = connected_user.get('status')
+        profile = connected_user.get('images', []).pop().get('url')
+
+        showImage(profile)
+
+        return '<Spotify (\'{}\' - {})>'.format(user, status)
+
+class AsyncSpotify(SpotifyBase):
+    def __init__(self, application_token, refresh_token, concurrency=8, timeout=10, retries=3, tokenfile=None, cache=None, keepRaw=False, scheduler=None, apiurl=None, accountsurl=None, client_id=None, coalesce=True, artwork=None, rateLimit=RATE_LIMIT):
+        import asyncio
+        import httpx
+
+        self._setup(application_token, refresh_token, client_id=client_id, tokenfile=tokenfile, cache=cache, scheduler=scheduler, retries=retries, keepRaw=keepRaw, apiurl=apiurl, accountsurl=accountsurl,
+                    rateLimit=rateLimit)
+
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+        # every request holds a connection slot, the scheduler paces them like the sync client's
+        self.limiter = asyncio.Semaphore(concurrency)
+
+        # identical GETs awaited at the same time share one request
+        self.coalesce = coalesce
+        self.inflight = {}
+        self.saved = 0
+
+        self.artwork = artwork
+        self.tokenLock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.get_access_token()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        self.cache.close()
+        await self.client.aclose()
+
+    async def _request(self, method, url, resource=None, priority='interactive', coalesce=True, **kwargs):
+        if 'params' in kwargs:
+            kwargs['params'] = requestParams(kwargs.get('params'))
+
+        start = time.perf_counter()
+
+        res, cache = await self._coalesced(method, url, resource, priority, coalesce, **kwargs)
+
+        # httpx has no hook for connection timings, so only the totals are recorded
+        if self.profiler is not None:
+            self._record(method, url, res, cache, start)
+
+        return res
+
+    async def _coalesced(self, method, url, resource=None, priority='interactive', coalesce=True, **kwargs):
+        import asyncio
+
+        if not (self.coalesce and coalesce and method == 'GET') or 'headers' in kwargs:
+            return await self._fetch(method, url, resource, priority, **kwargs)
+
+        key = cacheKey(method, url, kwargs.get('params'))
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.saved += 1
+
+            # one caller giving up must not cancel the request for the others
+            return (await asyncio.shield(task))[0], 'coalesced'
+
+        task = self.inflight[key] = asyncio.ensure_future(self._fetch(method, url, resource, priority, **kwargs))
+        task.add_done_callback(lambda t: self.inflight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _fetch(self, method, url, resource=None, priority='interactive', fresh=False, **kwargs):
+        if 'headers' in kwargs:
+            return await self.client.request(method, url, **kwargs), None
+
+        key, entry, hit, extra_headers = self._cacheLookup(method, url, resource, kwargs.get('params'), fresh)
+        if hit is not None:
+            return hit, 'hit'
+
+        res = await self._send(method, url, extra_headers, priority=priority, **kwargs)
+
+        return self._cacheStore(key, entry, resource, res)
+
+    async def _send(self, method, url, extra_headers, priority='interactive', **kwargs):
+        import asyncio
+
+        refresh = False
+        refreshed = False
+        attempt = 0
+
+        while True:
+            await self.get_access_token(force=refresh)
+
+            # the bucket is shared with threads, so waiting for a token happens off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.scheduler.acquire, priority)
+
+            async with self.limiter:
+                res = await self.client.request(method, url, headers=dict(self.headers, **extra_headers), **kwargs)
+
+            res.retries = attempt + int(refreshed)
+
+            refresh = res.status_code == 401 and not refreshed
+            if refresh:
+                # token was revoked or expired early, refresh once and replay
+                refreshed = True
+                continue
+
+            if res.status_code != 429 or attempt >= self.scheduler.retries:
+                return res
+
+            delay = self.scheduler.throttled(res.headers.get('Retry-After'), attempt)
+            if delay is None:
+                return res
+
+            print('Rate limited, retrying {} {} in {}s'.format(method, url, delay), file=VERBOSE_STDOUT, flush=True)
+            attempt += 1
+
+    async def request_token(self):
+        headers, payload = self._tokenRequest()
+
+        res = await self._request('POST', self.accountsurl + '/api/token', headers=headers, data=payload)
+        if res.status_code != 200:
+            print(res.json(), file=VERBOSE_STDOUT, flush=True)
+
+        return res.json()
+
+    async def get_access_token(self, force=False):
+        async with self.tokenLock:
+            token = self._cachedToken(force)
+            if token is not None:
+                return token
+
+            return self._storeToken(await self.request_token())
+
+    async def _getJson(self, url, resource=None, params=None):
+        return self._jsonResult(await self._request('GET', url, resource=resource, params=params))
+
+    async def getCurrentUser(self):
+        data = await self._getJson(self.apiurl + '/me', resource='user')
+        data['status'] = 'connected' if data.get('status') == 'success' else 'disconnected'
+
+        return data
+
+    async def iterPlaylists(self):
+        url = self.apiurl + '/me/playlists'
+        params = {'limit': Spotify.PAGE_LIMITS['playlists']}
+
+        while url is not None:
+            page = await self._getJson(url, resource='playlists', params=params)
+            if page.get('status') != 'success':
+                raise Exception('Unable to retrieve {} ({})'.format(url, page.get('status_code')))
+
+            for item in page.get('items', []):
+                yield Playlist.fromJson(item)
+
+            url = page.get('next')
+            params = None
+
+    async def getPlaylists(self):
+        data = {'status': 'success', 'items': [item async for item in self.iterPlaylists()]}
+        data['total'] = len(data['items'])
+
+        return data
+
+    async def getPlaylist(self, id, fields=None):
+        return await self._getJson(self.apiurl + '/playlists/{}'.format(id), resource='playlist', params={'fields': fields})
+
+    async def getPlayback(self):
+        data = await self._getJson(self.apiurl + '/me/player')
+        if data.get('status') != 'success':
+            return PlaybackState(status='error', status_code=data.get('status_code'))
+
+        return PlaybackState.fromJson(data, status_code=data.get('status_code'), keepRaw=self.keepRaw)
+
+    async def _fetchArtwork(self, url):
+        if self.artwork is None:
+            self.artwork = ArtworkCache(os.path.join(STATE_DIR, 'artwork'))
+
+        # artwork already on disk is not downloaded again
+        imgdata = self.artwork.cached(url)
+        if imgdata is not None:
+            return imgdata
+
+        async with self.limiter:
+            res = await self.client.get(url)
+
+        if res.status_code != 200:
+            return None
+
+        return self.artwork.original(url, res.content)
+
+    async def currentlyPlaying(self, artwork=False):
+        res = await self._request('GET', self.apiurl + '/me/player/currently-playing')
+        print(res.status_code, file=VERBOSE_STDOUT, flush=True)
+
+        if res.status_code == 200:
+            song_obj = res.json()
+            print(song_obj, file=VERBOSE_STDOUT, flush=True)
+
+            return await self._getSongData(song_obj, artwork=artwork)
+        elif res.status_code == 204:
+            return {'status': 'error', 'error': 'No track currently playing'}
+
+    async def _getSongData(self, song_obj, artwork=False):
+        import asyncio
+
+        playlistid = playlistContextId(song_obj)
+        data = songData(song_obj, keepRaw=self.keepRaw)
+
+        # playlist metadata and artwork do not depend on each other
+        lookups = [self.getPlaylist(playlistid, fields=PLAYLIST_CONTEXT_FIELDS) if playlistid is not None else asyncio.sleep(0)]
+        if artwork is True and data.get('artwork') is not None:
+            lookups.append(self._fetchArtwork(data.get('artwork')))
+
+        results = await asyncio.gather(*lookups)
+
+        if playlistid is not None:
+            data.setPlaylist(results[0])
+        if len(results) > 1:
+            data.artwork_data = results[1]
+
+        return data
+
+    async def controlPlayback(self, operation, device=None, uri=None, seekOffset=0):
+        import asyncio
+
+        operation = self._playbackOperation(operation)
+
+        # resolve the device alongside whatever state the operation needs
+        lookups = {}
+        if device:
+            lookups['deviceid'] = self._getDeviceId(device)
+
+        if operation in ('shuffle', 'repeat'):
+            lookups['playback'] = self.getPlayback()
+        elif operation == 'seek':
+            lookups['song'] = self.currentlyPlaying()
+
+        results = dict(zip(lookups.keys(), await asyncio.gather(*lookups.values())))
+
+        method, url, params = self._playbackRequest(operation, results.get('deviceid'), uri, seekOffset, results.get('playback'), results.get('song'))
+
+        return self._playbackResult(operation, await self._request(method, url, params=params))
+
+    async def _getDevices(self):
+        return await self._getJson(self.apiurl + '/me/player/devices', resource='devices')
+
+    async def getDevices(self):
+        return self._deviceMap(await self._getDevices())
+
+    async def _getDeviceId(self, device):
+        return self._deviceId(await self.getDevices(), device)
+
+    async def _recentlyPlayed(self, limit=20, before=None, after=None):
+        return await self._getJson(self.apiurl + '/me/player/recently-played', params=self._recentParams(limit, before, after))
+
+    async def getRecentlyPlayed(self, limit=20, before=None, after=None):
+        data = await self._recentlyPlayed(limit=limit, before=before, after=after)
+
+        return list(map(lambda s: songData(s, keepRaw=self.keepRaw), data['items']))
+
+async def runConcurrent(args, config, account=None):
+    cache = DiskCache(statePath('cache.json', account))
+
+    async with AsyncSpotify(config.get('app_token'), config.get('refresh_token'), client_id=config.get('client_id'), tokenfile=statePath('token.conf', account), cache=cache) as client:
+        with profiled(client, args):
+            if args.mode == 'status':
+                showimg = args.showimg or args.render is not None
+
+                printCurrentlyPlaying(await client.currentlyPlaying(artwork=showimg), showimg, asJson=args.json, render=args.render or 'auto')
+            elif args.mode == 'playback':
+                uri = args.uri if args.playback == 'queue' else None
+                seek = args.duration if args.playback == 'seek' else 0
+
+                printControlPlayback(await client.controlPlayback(args.playback, device=args.device, uri=uri, seekOffset=seek), asJson=args.json)
+            elif args.mode == 'devices':
+                printDevices(await client.getDevices(), asJson=args.json)
+
+def readBatch(path, cwd=None, readStdin=None):
+    if path == '-':
+        return readStdin() if readStdin is not None else sys.stdin.read()
+
+    # relative to where the command was typed, which is not where a daemon runs
+    with open(os.path.join(cwd or os.getcwd(), path)) as batchfd:
+        return batchfd.read()
+
+def resolveInputs(args, cwd=None, readStdin=None):
+    if args.mode == 'batch':
+        args.script = readBatch(args.file, cwd, readStdin)
+    elif args.mode == 'playlist' and args.operation == 'sync':
+        args.tracklist = readBatch(args.file, cwd, readStdin)
+
+    for export in ('profile_json', 'profile_prometheus'):
+        if getattr(args, export) is not None:
+            setattr(args, export, os.path.abspath(os.path.join(cwd or os.getcwd(), getattr(args, export))))
+
+def runsLocally(args):
+    # setup and the daemon itself need this process, and a watch would tie the daemon up
+    return args.mode in ('setup', 'daemon') or (args.mode == 'status' and args.watch)
+
+def parseBatchLine(line):
+    # either a JSON object or the words the CLI takes, 'playback' being optional
+    if line.startswith('{'):
+        command = json.loads(line)
+        if isinstance(command.get('songs'), str):
+            command['songs'] = [command.get('songs')]
+
+        return command
+
+    words = shlex.split(line)
+    if words[0] == 'playback':
+        words = words[1:]
+
+    if len(words) == 0:
+        raise Exception('Missing playback operation')
+
+    if words[0] == 'playlist':
+        if len(words) < 4:
+            raise Exception('Usage: playlist add|remove <playlist> <uri> [<uri> ...]')
+
+        return {'op': 'playlist', 'operation': words[1], 'playlist': words[2], 'songs': words[3:]}
+
+    command = {'op': words[0]}
+    if words[0] == 'queue':
+        if len(words) < 2:
+            raise Exception('Usage: queue <uri>')
+
+        command['uri'] = words[1]
+    elif words[0] == 'seek':
+        if len(words) < 2:
+            raise Exception('Usage: seek <duration>')
+
+        command['duration'] = int(words[1])
+
+    return command
+
+def parseBatch(script):
+    if script.lstrip().startswith('['):
+        return list(map(lambda c: dict(c[1], line=c[0], text=json.dumps(c[1])), enumerate(json.loads(script), start=1)))
+
+    commands = []
+    for idx, line in enumerate(script.splitlines(), start=1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+
+        try:
+            command = parseBatchLine(line)
+        except Exception as e:
+            # a bad line fails on its own instead of aborting the whole batch
+            command = {'error': str(e)}
+
+        command['line'] = idx
+        command['text'] = line
+        commands.append(command)
+
+    return commands
+
+def buildParser():
+    # argparsejson pulls in jsonschema, which a forwarded command never needs
+    from argparsejson import argparsejson
+
+    return argparsejson.parse_arguments(os.path.join(SCRIPT_DIR, "commands.json"), prog=__file__)
+
+def createClient(config, account=None, session=None, scheduler=None, rateLimit=RATE_LIMIT):
+    app_token = config.get('app_token')
+    refresh_token = config.get('refresh_token')
+
+    client = Spotify(app_token, refresh_token, client_id=config.get('client_id'), session=session, scheduler=scheduler, rateLimit=rateLimit,
+                     tokenfile=statePath('token.conf', account), cache=DiskCache(statePath('cache.json', account)))
+    client.account = account
+
+    return client
+
+def selectAccounts(args, accounts):
+    if getattr(args, 'all_accounts', False):
+        return list(accounts)
+
+    names = getattr(args, 'account', None) or [next(iter(accounts))]
+
+    for name in names:
+        if name not in accounts:
+            raise Exception('Unknown account \'{}\'! Configured accounts: {}'.format(name, ', '.join(accounts)))
+
+    return list(OrderedDict.fromkeys(names))
+
+class SpotifyPool:
+    def __init__(self, accounts, workers=8, rateLimit=RATE_LIMIT):
+        self.accounts = accounts
+        self.workers = workers
+        self.rateLimit = rateLimit
+
+        # every account talks to the same two hosts, so one keep-alive pool serves them all
+        self.session = createSession(pool_size=max(10, workers))
+
+        # Spotify rate limits per application, not per account
+        self.schedulers = {}
+        self.clients = OrderedDict()
+
+        # the daemon asks for clients from many threads
+        self.lock = threading.Lock()
+
+    def client(self, name):
+        with self.lock:
+            if name not in self.clients:
+                config = self.accounts[name]
+                app = config.get('client_id') or config.get('app_token')
+
+                if app not in self.schedulers:
+                    self.schedulers[app] = RequestScheduler(limit=self.rateLimit)
+
+                self.clients[name] = createClient(config, account=name, session=self.session, scheduler=self.schedulers[app])
+
+            return self.clients[name]
+
+    def map(self, fn, names=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        names = list(names) if names is not None else list(self.accounts)
+        clients = list(map(self.client, names))
+
+        def run(client):
+            try:
+                return fn(client)
+            except Exception as e:
+                return {'status': 'error', 'error': str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(min(self.workers, len(names)), 1)) as executor:
+            results = list(executor.map(inContext(run), clients))
+
+        return OrderedDict(zip(names, results))
+
+    def update(self, accounts):
+        # clients of removed or changed accounts are created again on next use
+        with self.lock:
+            for name, client in list(self.clients.items()):
+                if accounts.get(name) != self.accounts.get(name):
+                    client.cache.close()
+                    del self.clients[name]
+
+            self.accounts = accounts
+
+    def save(self):
+        with self.lock:
+            clients = list(self.clients.values())
+
+        for client in clients:
+            client.cache.save()
+
+    def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+
+        for client in clients:
+            client.cache.close()
+
+        self.session.close()
+
+class BinaryWriter:
+    # the .buffer of a stdout stand-in, for writers like imgcat that send bytes
+    def __init__(self, write, flush):
+        self.write = write
+        self.flush = flush
+
+class ThreadOutput:
+    # stands in for sys.stdout/sys.stderr so every fan-out thread and daemon command writes
+    # to its own stream, anything else goes to the one it replaced
+    def __init__(self, stream):
+        self.stream = stream
+        self.target = contextvars.ContextVar('output', default=None)
+        self.buffer = BinaryWriter(self.writeBytes, self.flush)
+
+    @contextlib.contextmanager
+    def route(self, target):
+        token = self.target.set(target)
+
+        try:
+            yield target
+        finally:
+            self.target.reset(token)
+
+    def capture(self):
+        # bytes, so text and imgcat's binary output stay in the order they were written
+        return self.route(io.BytesIO())
+
+    def write(self, text):
+        target = self.target.get() or self.stream
+        if not isinstance(target, io.BytesIO):
+            return target.write(text)
+
+        target.write(text.encode('utf-8'))
+        return len(text)
+
+    def writeBytes(self, data):
+        target = self.target.get() or self.stream
+        if not isinstance(target, io.BytesIO):
+            return target.buffer.write(data)
+
+        return target.write(data)
+
+    def flush(self):
+        target = self.target.get() or self.stream
+        if not isinstance(target, io.BytesIO):
+            target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+THREAD_OUTPUT_LOCK = threading.Lock()
+
+def threadOutputs():
+    # installed once and left in place, swapping sys.stdout per command is not thread safe
+    with THREAD_OUTPUT_LOCK:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr)
+
+    return sys.stdout, sys.stderr
+
+def runAccounts(pool, args, names):
+    if args.mode == 'status' and args.watch:
+        raise Exception('--watch follows a single account, pick one with --account')
+
+    stdout, stderr = threadOutputs()
+
+    def run(client):
+        with stdout.capture() as out, stderr.capture() as err:
+            try:
+                runProfiled(client, args)
+                result = {'status': 'success'}
+            except Exception as e:
+                result = {'status': 'error', 'error': str(e)}
+
+            return dict(result, out=out.getvalue(), err=err.getvalue())
+
+    results = pool.map(run, names)
+
+    # printed in config order once everything is back, so accounts never interleave
+    failed = []
+    for name, result in results.items():
+        if args.json:
+            printJson({'account': name, 'status': result.get('status')})
+        else:
+            print('== {} =='.format(name))
+
+        for stream, captured in ((sys.stdout, result.get('out', b'')), (sys.stderr, result.get('err', b''))):
+            stream.flush()
+            stream.buffer.write(captured)
+            stream.buffer.flush()
+
+        if result.get('status') != 'success':
+            print('{}: {}'.format(name, result.get('error')), file=sys.stderr)
+            failed.append(name)
+
+    sys.stdout.flush()
+
+    if len(failed) > 0:
+        raise Exception('{} of {} accounts failed: {}'.format(len(failed), len(names), ', '.join(failed)))
+
+    return results
+
+def runAccount(pool, args):
+    names = selectAccounts(args, pool.accounts)
+
+    if len(names) == 1:
+        return runProfiled(pool.client(names[0]), args)
+
+    return runAccounts(pool, args, names)
+
+class DaemonWriter:
+    def __init__(self, wfile, stream='out'):
+        self.wfile = wfile
+        self.stream = stream
+        self.buffer = BinaryWriter(self.writeBytes, self.flush)
+
+    def write(self, text):
+        if len(text) > 0:
+            self.wfile.write((json.dumps({self.stream: text}) + '\n').encode('utf-8'))
+
+        return len(text)
+
+    def writeBytes(self, data):
+        if len(data) > 0:
+            self.wfile.write((json.dumps({self.stream + '_bytes': b64encode(data).decode('ascii')}) + '\n').encode('utf-8'))
+
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        writer = DaemonWriter(self.wfile)
+
+        if request.get('ping') is True:
+            self._send({'exit': 0})
+            return
+
+        if request.get('stop') is True:
+            writer.write('Stopping daemon on {}\n'.format(self.server.server_address))
+            self._send({'exit': 0})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        stdout, stderr = threadOutputs()
+
+        # the client forwards its argv untouched, parsing it is left to the warm daemon
+        try:
+            with stdout.route(writer), stderr.route(DaemonWriter(self.wfile, stream='err')):
+                args = self.server.parser.parse_args(request.get('argv', []))
+        except SystemExit as e:
+            self._send({'exit': e.code if isinstance(e.code, int) else 1})
+            return
+
+        if args.mode is None:
+            with stdout.route(writer):
+                self.server.parser.print_help()
+            self._send({'exit': 0})
+            return
+
+        if runsLocally(args):
+            self._send({'local': True})
+            return
+
+        # output and the terminal artwork is drawn for belong to this command only,
+        # other commands run on their own threads at the same time
+        CLIENT_TERMINAL.set(request.get('terminal'))
+
+        status = 0
+        try:
+            with stdout.route(writer), stderr.route(DaemonWriter(self.wfile, stream='err')), VERBOSE_STDOUT.route(writer if args.verbose else None):
+                self.server.reloadAccounts()
+                resolveInputs(args, request.get('cwd'), self._readStdin)
+                runAccount(self.server.pool, args)
+        except Exception as e:
+            self._send({'error': str(e)})
+            status = 1
+        finally:
+            self.server.pool.save()
+
+        self._send({'exit': status})
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def _readStdin(self):
+        # only the client can read its stdin, so ask for it
+        self._send({'stdin': True})
+
+        return json.loads(self.rfile.readline()).get('stdin')
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # a hotkey must not wait behind a long library index
+    daemon_threads = True
+
+    def __init__(self, socketpath, configfile=None):
+        global VERBOSE_STDOUT
+
+        self.configfile = configfile if configfile is not None else CONFIG_FILE
+        self.configMtime = self._configMtime()
+        self.configLock = threading.Lock()
+
+        # clients for every account are created on first use and then stay warm
+        self.pool = SpotifyPool(parse_accounts(self.configfile))
+        self.parser = buildParser()
+
+        # every command sends its output to its own client
+        threadOutputs()
+        if not isinstance(VERBOSE_STDOUT, ThreadOutput):
+            VERBOSE_STDOUT = ThreadOutput(VERBOSE_STDOUT)
+
+        super().__init__(socketpath, DaemonHandler)
+
+    def _configMtime(self):
+        try:
+            return os.stat(self.configfile).st_mtime_ns
+        except OSError:
+            return None
+
+    def reloadAccounts(self):
+        # accounts set up or changed while the daemon runs are picked up without a restart
+        with self.configLock:
+            mtime = self._configMtime()
+            if mtime != self.configMtime:
+                self.pool.update(parse_accounts(self.configfile))
+                self.configMtime = mtime
+
+def runDaemon(configfile=None, socketpath=DAEMON_SOCKET):
+    if forwardCommand({'ping': True}, socketpath=socketpath) is not None:
+        raise Exception('Daemon is already running on {}'.format(socketpath))
+
+    if os.path.exists(socketpath):
+        # left behind by a daemon that did not shut down cleanly
+        os.unlink(socketpath)
+
+    umask = os.umask(0o077)
+    try:
+        server = DaemonServer(socketpath, configfile)
+    finally:
+        os.umask(umask)
+
+    print('Listening on {}'.format(socketpath))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        os.unlink(socketpath)
+
+def forwardCommand(request, socketpath=DAEMON_SOCKET):
+    if not os.path.exists(socketpath):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath)
+    except OSError:
+        sock.close()
+        return None
+
+    status = 1
+
+    with sock, sock.makefile('rwb') as sockfile:
+        sockfile.write((json.dumps(request) + '\n').encode('utf-8'))
+        sockfile.flush()
+
+        for line in sockfile:
+            message = json.loads(line)
+
+            if 'out' in message:
+                sys.stdout.write(message.get('out'))
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message.get('err'))
+                sys.stderr.flush()
+            elif 'out_bytes' in message or 'err_bytes' in message:
+                stream = sys.stdout if 'out_bytes' in message else sys.stderr
+                stream.flush()
+                stream.buffer.write(b64decode(message.get('out_bytes', message.get('err_bytes'))))
+                stream.buffer.flush()
+            elif 'stdin' in message:
+                sockfile.write((json.dumps({'stdin': sys.stdin.read()}) + '\n').encode('utf-8'))
+                sockfile.flush()
+            elif 'local' in message:
+                return None
+            elif 'error' in message:
+                print(message.get('error'), file=sys.stderr, flush=True)
+            elif 'exit' in message:
+                status = message.get('exit')
+
+    return status
+
+def commandName(args):
+    words = [args.mode]
+    for dest in ('playback', 'operation', 'user', 'history', 'library'):
+        if isinstance(getattr(args, dest, None), str):
+            words.append(getattr(args, dest))
+
+    return ' '.join(words)
+
+@contextlib.contextmanager
+def profiled(client, args):
+    if not (args.profile or args.profile_json or args.profile_prometheus):
+        yield None
+        return
+
+    profiler = client.profiler = RequestProfiler(commandName(args))
+
+    try:
+        yield profiler
+    finally:
+        client.profiler = None
+
+        if args.profile:
+            profiler.printReport()
+        if args.profile_json:
+            profiler.exportJson(args.profile_json)
+        if args.profile_prometheus:
+            profiler.exportPrometheus(args.profile_prometheus)
+
+def runProfiled(client, args):
+    # a watch has to see every poll, anything else reads each resource once
+    if args.mode == 'status' and args.watch:
+        scope = contextlib.nullcontext()
+    else:
+        scope = client.coalesceScope()
+
+    with profiled(client, args), scope:
+        runCommand(client, args)
+
+def runCommand(client, args):
+    if args.mode == 'status':
+        # picking a renderer implies showing the artwork
+        if args.showimg or args.render is not None:
+            showimg = True
+        else:
+            showimg = False
+
+        render = args.render or 'auto'
+
+        if args.watch:
+            try:
+                for song in client.watchPlayback(maxInterval=args.interval):
+                    if song.get('status') == 'success' or args.json:
+                        printCurrentlyPlaying(song, showimg, asJson=args.json, render=render)
+                    else:
+                        print(song.get('error'), flush=True)
+            except KeyboardInterrupt:
+                pass
+        else:
+            printCurrentlyPlaying(client.currentlyPlaying(), showimg, asJson=args.json, render=render)
+
+    elif args.mode == 'playback':
+        if args.playback:
+            operation = args.playback
+        else:
+            operation = None
+
+        if args.device:
+            device = args.device
+        else:
+            device = None
+
+        if operation == "queue" and args.uri:
+            uri = args.uri
+        else:
+            uri = None
+
+        if operation == "seek":
+            seek = args.duration
+        else:
+            seek = 0
+
+        status = client.controlPlayback(operation, device=device, uri=uri, seekOffset=seek)
+        printControlPlayback(status, asJson=args.json)
+
+    elif args.mode == 'playlist' and args.operation == 'list':
+        printPlaylists(client.iterPlaylists(), asJson=args.json)
+
+    elif args.mode == 'playlist' and args.operation == 'tracks':
+        playlistid = client.resolvePlaylist(args.playlist)
+        if playlistid is None:
+            raise Exception('Invalid playlist name or id!')
+
+        printTracks(client.iterPlaylistTracks(playlistid), asJson=args.json)
+
+    elif args.mode == 'playlist' and args.operation == 'find':
+        import library
+
+        index = library.LibraryIndex(statePath('library.db', client.account))
+
+        if args.refresh or len(index) == 0:
+            index.refresh(client)
+
+        if args.artist:
+            matches = index.findArtist(args.artist)
+        elif args.album:
+            matches = index.findAlbum(args.album)
+        elif args.nowplaying:
+            song = client.currentlyPlaying()
+            if song.get('status') != 'success':
+                raise Exception('Nothing is playing!')
+
+            if args.by_artist:
+                matches = index.findArtist(song.artist_uris[0])
+            elif args.by_album:
+                matches = index.findAlbum(song.album_uri)
+            else:
+                matches = index.findTracks([song.uri])
+        else:
+            matches = index.findTracks(args.song)
+
+        index.close()
+
+        printFindResults(matches, asJson=args.json)
+
+    elif args.mode == 'playlist' and args.operation == 'sync':
+        import library
+
+        playlistid = client.resolvePlaylist(args.playlist)
+        if playlistid is None:
+            raise Exception('Invalid playlist name or id!')
+
+        index = library.LibraryIndex(statePath('library.db', client.account))
+        data = client.syncPlaylist(playlistid, parseTrackList(args.tracklist), dryRun=args.dry_run, known=lambda snapshot_id: index.trackUris(playlistid, snapshot_id))
+        index.close()
+
+        printSyncResults(data, asJson=args.json)
+
+        if data.get('status') != 'success':
+            raise Exception('Playlist sync did not complete')
+
+    elif args.mode == 'playlist':
+        if args.operation:
+            operation = args.operation
+        else:
+            operation = None
+
+        if args.nowplaying:
+            nowplaying = args.nowplaying
+        else:
+            nowplaying = False
+
+        if args.playlist:
+            playlist = args.playlist
+        else:
+            playlist = None
+
+        if args.song:
+            songs = args.song
+        elif nowplaying is True:
+            songs = [client.currentlyPlaying().get('uri')]
+        else:
+            songs = []
+
+        if args.device:
+            device = args.device
+        else:
+            device = None
+
+        results = client.playlist(operation, playlist, songs, device=device)
+        printPlaylistResults(results, asJson=args.json)
+
+    elif args.mode == 'devices':
+        devices = client.getDevices()
+        printDevices(devices, asJson=args.json)
+
+    elif args.mode == 'user':
+        if args.user == 'recents':
+            if args.before:
+                before = args.before
+            else:
+                before = None
+
+            if args.after:
+                after = args.after
+            else:
+                after = None
+
+            if args.limit:
+                limit = args.limit
+            else:
+                limit = None
+
+            if args.local:
+                import history
+
+                # same default page size as the API
+                store = history.HistoryStore(statePath('history.db', client.account))
+                recents = store.query(since=after, until=before, limit=limit if limit is not None else 20)
+                store.close()
+            else:
+                recents = client.getRecentlyPlayed(limit=limit, before=before, after=after)
+
+            printRecents(recents, asJson=args.json)
+        elif args.user == 'history':
+            import history
+
+            historydb = statePath('history.db', client.account)
+            store = history.HistoryStore(historydb)
+
+            if args.history == 'sync':
+                added = store.sync(client)
+
+                if args.json:
+                    printJson({'added': added, 'path': historydb})
+                else:
+                    print('Added {} new plays to {}'.format(added, historydb))
+            elif args.history == 'show':
+                printRecents(store.iterQuery(since=args.since, until=args.until, limit=args.limit, track=args.track, artist=args.artist), asJson=args.json)
+
+            store.close()
+        elif args.user == 'status':
+            if args.json:
+                printJson(client.getCurrentUser())
+            else:
+                print(client)
+
+    elif args.mode == 'batch':
+        failed = 0
+        commands = parseBatch(args.script)
+
+        for command, result in client.batch(commands, device=args.device):
+            printBatchResult(command, result, asJson=args.json)
+
+            if result.get('status') != 'success':
+                failed += 1
+
+        if failed > 0:
+            raise Exception('{} of {} batch commands failed'.format(failed, len(commands)))
+
+    elif args.mode == 'library':
+        import library
+
+        libraryfile = statePath('library.db', client.account)
+        index = library.LibraryIndex(libraryfile)
+
+        if args.library == 'index':
+            start = time.perf_counter()
+            counts = index.refresh(client, full=args.full)
+
+            if args.json:
+                printJson(dict(counts, seconds=round(time.perf_counter() - start, 3), path=libraryfile))
+            else:
+                print('Indexed {} playlists in {:.1f}s: {} updated, {} unchanged, {} removed ({})'.format(counts.get('playlists'), time.perf_counter() - start, counts.get('updated'),
+                                                                                                 counts.get('unchanged'), counts.get('removed'), libraryfile))
+
+        index.close()
+
+    elif args.mode == 'stats':
+        import stats
+
+        if args.recent:
+            listening = stats.Listening.fromItems(client._recentlyPlayed(limit=50).get('items', [])).between(args.since, args.until)
+        else:
+            import history
+
+            store = history.HistoryStore(statePath('history.db', client.account))
+            listening = stats.Listening.fromStore(store, cachepath=statePath('history.npz', client.account), since=args.since, until=args.until)
+
+        summary = listening.summary(top=args.top, gap_ms=args.gap * 60 * 1000)
+
+        if args.json:
+            printJson(summary)
+        else:
+            stats.printSummary(summary)
+
+        if not args.recent:
+            store.close()
+
+if __name__ == "__main__":
+    # a running daemon parses and runs the command, so nothing heavy is imported before asking it
+    status = forwardCommand({'argv': sys.argv[1:], 'cwd': os.getcwd(), 'terminal': terminalInfo()})
+
+    if status is not None:
+        sys.exit(status)
+
+    parser = buildParser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        VERBOSE_STDOUT = sys.stdout
+    else:
+        VERBOSE_STDOUT = open(os.devnull, 'w')
+
+    print(args, file=VERBOSE_STDOUT, flush=True)
+
+    if args.mode is None:
+        parser.print_help()
+    elif args.mode == 'setup':
+        scopes = fetchScopes() if args.refresh_scopes else loadScopes()
+
+        if args.choose_scopes:
+            scopes = chooseScopes(scopes)
+        elif not args.all_scopes:
+            scopes = DEFAULT_SCOPES
+
+        setupSpotify(args.clientid, args.clientsecret, scopes=scopes, redirect_uri=args.redirect_uri, openBrowser=not args.no_browser, timeout=args.timeout,
+                     account=args.account[0] if args.account else None)
+    elif args.mode == 'daemon':
+        if args.stop:
+            forwardCommand({'stop': True})
+        else:
+            # let kill/systemd stop the daemon through the normal cleanup path
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+            runDaemon()
+    else:
+        resolveInputs(args)
+
+        accounts = parse_accounts()
+        names = selectAccounts(args, accounts)
+
+        if len(names) > 1:
+            pool = SpotifyPool(accounts)
+
+            try:
+                runAccounts(pool, args, names)
+            finally:
+                pool.close()
+        elif args.concurrent and args.mode in ('status', 'playback', 'devices') and not getattr(args, 'watch', False):
+            import asyncio
+
+            asyncio.run(runConcurrent(args, accounts[names[0]], account=names[0]))
+        else:
+            client = createClient(accounts[names[0]], account=names[0])
+
+            try:
+                runProfiled(client, args)
+            finally:
+                client.close()
 
     if not args.verbose:
         VERBOSE_STDOUT.close()
@@ -0,0 +1,271 @@
+import os
+import time
+
+import numpy as np
+
+import history
+
+def emptyColumns():
+    # played_at, durations and track_ids have one entry per play, the artist_ columns
+    # one per credited artist, so featured artists count as well
+    return {
+        'played_at': np.array([], dtype=np.int64),
+        'durations': np.array([], dtype=np.int64),
+        'track_ids': np.array([], dtype=np.int64),
+        'artist_played_at': np.array([], dtype=np.int64),
+        'artist_durations': np.array([], dtype=np.int64),
+        'artist_ids': np.array([], dtype=np.int64),
+        'track_uris': np.array([], dtype=str),
+        'artist_uris': np.array([], dtype=str)
+    }
+
+def factorize(values, uris):
+    index = dict(zip(uris, range(len(uris))))
+    ids = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64, count=len(values))
+
+    # dicts keep insertion order, so new uris land after the existing ones
+    return ids, np.array(list(index), dtype=str)
+
+def loadColumns(store, cachepath=None):
+    columns = None
+
+    source = os.path.abspath(store.path)
+
+    if cachepath is not None and os.path.exists(cachepath):
+        try:
+            with np.load(cachepath, allow_pickle=False) as data:
+                columns = dict(map(lambda k: (k, data[k]), data.files))
+        except (OSError, ValueError):
+            columns = None
+
+    if columns is not None and not cacheMatches(store, columns, source):
+        columns = None
+
+    if columns is None:
+        columns = emptyColumns()
+
+    newest = int(columns['played_at'][-1]) if len(columns['played_at']) > 0 else -1
+
+    # history only ever grows at the end, so only newer plays need converting
+    rows = store.conn.execute('SELECT played_at, COALESCE(duration_ms, 0), track_uri FROM plays WHERE played_at > ? ORDER BY played_at', (newest,)).fetchall()
+
+    if len(rows) > 0:
+        credits = store.conn.execute('SELECT a.played_at, COALESCE(p.duration_ms, 0), a.artist_uri FROM play_artists a JOIN plays p ON p.played_at = a.played_at WHERE a.played_at > ? ORDER BY a.played_at',
+                                     (newest,)).fetchall()
+
+        track_ids, columns['track_uris'] = factorize(list(map(lambda r: r[2], rows)), columns['track_uris'].tolist())
+        artist_ids, columns['artist_uris'] = factorize(list(map(lambda r: r[2], credits)), columns['artist_uris'].tolist())
+
+        columns['played_at'] = np.concatenate((columns['played_at'], np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))))
+        columns['durations'] = np.concatenate((columns['durations'], np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))))
+        columns['track_ids'] = np.concatenate((columns['track_ids'], track_ids))
+        columns['artist_played_at'] = np.concatenate((columns['artist_played_at'], np.fromiter((r[0] for r in credits), dtype=np.int64, count=len(credits))))
+        columns['artist_durations'] = np.concatenate((columns['artist_durations'], np.fromiter((r[1] for r in credits), dtype=np.int64, count=len(credits))))
+        columns['artist_ids'] = np.concatenate((columns['artist_ids'], artist_ids))
+
+        if cachepath is not None:
+            tmpfile = cachepath + '.tmp'
+            with open(tmpfile, 'wb') as cachefd:
+                np.savez(cachefd, source=np.array(source), **columns)
+
+            os.replace(tmpfile, cachepath)
+
+    columns.pop('source', None)
+
+    return columns
+
+def cacheMatches(store, columns, source):
+    if not set(emptyColumns()).issubset(columns) or 'source' not in columns or str(columns['source']) != source:
+        return False
+
+    newest = int(columns['played_at'][-1]) if len(columns['played_at']) > 0 else -1
+
+    # a recreated or rewritten database no longer has the plays the cache was built from
+    stored = store.conn.execute('SELECT COUNT(*) FROM plays WHERE played_at <= ?', (newest,)).fetchone()[0]
+
+    return stored == len(columns['played_at'])
+
+class Listening:
+    def __init__(self, columns, labels):
+        self.played_at = columns['played_at']
+        self.durations = columns['durations']
+        self.track_ids = columns['track_ids']
+        self.artist_played_at = columns['artist_played_at']
+        self.artist_durations = columns['artist_durations']
+        self.artist_ids = columns['artist_ids']
+        self.track_uris = columns['track_uris']
+        self.artist_uris = columns['artist_uris']
+
+        # called with ('track' | 'artist', uri) to name the few rows that get printed
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.played_at)
+
+    @classmethod
+    def fromStore(cls, store, cachepath=None, since=None, until=None):
+        def labels(kind, uri):
+            if kind == 'track':
+                row = store.conn.execute('SELECT track, artist FROM plays WHERE track_uri = ? LIMIT 1', (uri,)).fetchone()
+                return {'uri': uri, 'track': row[0] if row is not None else None, 'artist': row[1] if row is not None else None}
+
+            # plays migrated from before play_artists only have the joined credits
+            row = store.conn.execute('SELECT artist FROM play_artists WHERE artist_uri = ? AND artist IS NOT NULL LIMIT 1', (uri,)).fetchone()
+            if row is None:
+                row = store.conn.execute('SELECT artist FROM plays WHERE artist_uri = ? LIMIT 1', (uri,)).fetchone()
+
+            return {'uri': uri, 'artist': row[0] if row is not None else None}
+
+        return cls(loadColumns(store, cachepath), labels).between(since, until)
+
+    @classmethod
+    def fromItems(cls, items):
+        items = sorted(items, key=lambda i: history.parseTimestamp(i.get('played_at')))
+        rows = list(map(history.playRow, items))
+
+        durations = {}
+        names = {}
+        for row in rows:
+            durations[row[0]] = row[6] or 0
+            names.setdefault(('track', row[1]), {'uri': row[1], 'track': row[2], 'artist': row[4]})
+
+        credits = [credit for item in items for credit in history.artistRows(item)]
+        for credit in credits:
+            names.setdefault(('artist', credit[0]), {'uri': credit[0], 'artist': credit[2]})
+
+        columns = emptyColumns()
+        columns['played_at'] = np.array(list(map(lambda r: r[0], rows)), dtype=np.int64)
+        columns['durations'] = np.array(list(map(lambda r: r[6] or 0, rows)), dtype=np.int64)
+        columns['track_ids'], columns['track_uris'] = factorize(list(map(lambda r: r[1], rows)), [])
+        columns['artist_played_at'] = np.array(list(map(lambda c: c[1], credits)), dtype=np.int64)
+        columns['artist_durations'] = np.array(list(map(lambda c: durations.get(c[1]), credits)), dtype=np.int64)
+        columns['artist_ids'], columns['artist_uris'] = factorize(list(map(lambda c: c[0], credits)), [])
+
+        return cls(columns, lambda kind, uri: names.get((kind, uri)))
+
+    def between(self, since=None, until=None):
+        start, end = self._window(self.played_at, since, until)
+        artist_start, artist_end = self._window(self.artist_played_at, since, until)
+
+        if start == 0 and end == len(self) and artist_start == 0 and artist_end == len(self.artist_ids):
+            return self
+
+        columns = {
+            'played_at': self.played_at[start:end],
+            'durations': self.durations[start:end],
+            'track_ids': self.track_ids[start:end],
+            'artist_played_at': self.artist_played_at[artist_start:artist_end],
+            'artist_durations': self.artist_durations[artist_start:artist_end],
+            'artist_ids': self.artist_ids[artist_start:artist_end],
+            'track_uris': self.track_uris,
+            'artist_uris': self.artist_uris
+        }
+
+        return Listening(columns, self.labels)
+
+    def _window(self, played_at, since, until):
+        start = np.searchsorted(played_at, history.parseTimestamp(since), side='right') if since is not None else 0
+        end = np.searchsorted(played_at, history.parseTimestamp(until), side='left') if until is not None else len(played_at)
+
+        return start, end
+
+    def _top(self, kind, ids, uris, durations, n, byTime=False):
+        counts = np.bincount(ids, minlength=len(uris))
+        listened = np.bincount(ids, weights=durations, minlength=len(uris))
+        totals = listened if byTime else counts
+
+        n = min(n, np.count_nonzero(counts))
+        if n == 0:
+            return []
+
+        top = np.argpartition(-totals, n - 1)[:n]
+        top = top[np.argsort(-totals[top], kind='stable')]
+
+        return list(map(lambda i: dict(self.labels(kind, str(uris[i])), plays=int(counts[i]), listened_ms=int(listened[i])), top))
+
+    def topTracks(self, n=10, byTime=False):
+        return self._top('track', self.track_ids, self.track_uris, self.durations, n, byTime=byTime)
+
+    def topArtists(self, n=10, byTime=False):
+        return self._top('artist', self.artist_ids, self.artist_uris, self.artist_durations, n, byTime=byTime)
+
+    def hourly(self, utcoffset=None):
+        if utcoffset is None:
+            utcoffset = time.localtime().tm_gmtoff
+
+        hours = ((self.played_at // 1000 + utcoffset) // 3600) % 24
+
+        return np.bincount(hours, minlength=24)
+
+    def weekdays(self, utcoffset=None):
+        if utcoffset is None:
+            utcoffset = time.localtime().tm_gmtoff
+
+        # 1970-01-01 was a Thursday, shift so Monday is 0
+        days = ((self.played_at // 1000 + utcoffset) // 86400 + 3) % 7
+
+        return np.bincount(days, minlength=7)
+
+    def sessions(self, gap_ms=30 * 60 * 1000):
+        if len(self) == 0:
+            return {'count': 0, 'starts': np.array([], dtype=np.int64), 'lengths_ms': np.array([], dtype=np.int64), 'plays': np.array([], dtype=np.int64)}
+
+        # played_at marks when a track finished, so a new session begins wherever
+        # a track started more than gap_ms after the previous one finished
+        breaks = np.flatnonzero(np.diff(self.played_at) - self.durations[1:] > gap_ms) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(self)])) - 1
+
+        lengths = self.played_at[ends] - self.played_at[starts] + self.durations[starts]
+
+        return {'count': len(starts), 'starts': self.played_at[starts], 'lengths_ms': lengths, 'plays': ends - starts + 1}
+
+    def listeningTime(self):
+        return int(self.durations.sum())
+
+    def summary(self, top=10, gap_ms=30 * 60 * 1000):
+        sessions = self.sessions(gap_ms=gap_ms)
+
+        return {
+            'plays': len(self),
+            'first_played_at': int(self.played_at[0]) if len(self) > 0 else None,
+            'last_played_at': int(self.played_at[-1]) if len(self) > 0 else None,
+            'listened_ms': self.listeningTime(),
+            'unique_tracks': int(np.count_nonzero(np.bincount(self.track_ids, minlength=len(self.track_uris)))),
+            'unique_artists': int(np.count_nonzero(np.bincount(self.artist_ids, minlength=len(self.artist_uris)))),
+            'top_tracks': self.topTracks(top),
+            'top_artists': self.topArtists(top),
+            'hourly': self.hourly().tolist(),
+            'weekdays': self.weekdays().tolist(),
+            'sessions': sessions['count'],
+            'average_session_ms': int(sessions['lengths_ms'].mean()) if sessions['count'] > 0 else 0,
+            'longest_session_ms': int(sessions['lengths_ms'].max()) if sessions['count'] > 0 else 0
+        }
+
+def formatDuration(ms):
+    minutes = ms // 60000
+
+    return '{}h {:02d}m'.format(minutes // 60, minutes % 60)
+
+def printSummary(summary):
+    msg = 'Plays: {}\n'.format(summary.get('plays'))
+    msg += 'Listening time: {}\n'.format(formatDuration(summary.get('listened_ms')))
+    msg += 'Unique tracks: {}\n'.format(summary.get('unique_tracks'))
+    msg += 'Unique artists: {}\n'.format(summary.get('unique_artists'))
+    msg += 'Sessions: {} (average {}, longest {})\n'.format(summary.get('sessions'), formatDuration(summary.get('average_session_ms')), formatDuration(summary.get('longest_session_ms')))
+
+    msg += '\nTop tracks:\n'
+    for idx, track in enumerate(summary.get('top_tracks'), start=1):
+        msg += '{:>3}. \'{}\' by \'{}\' - {} plays\n'.format(idx, track.get('track'), track.get('artist'), track.get('plays'))
+
+    msg += '\nTop artists:\n'
+    for idx, artist in enumerate(summary.get('top_artists'), start=1):
+        msg += '{:>3}. \'{}\' - {} plays, {}\n'.format(idx, artist.get('artist'), artist.get('plays'), formatDuration(artist.get('listened_ms')))
+
+    msg += '\nPlays per hour:\n'
+    hourly = summary.get('hourly')
+    peak = max(max(hourly), 1)
+    for hour, plays in enumerate(hourly):
+        msg += '{:02d}:00 {:<40} {}\n'.format(hour, '#' * round(40 * plays / peak), plays)
+
+    print(msg)
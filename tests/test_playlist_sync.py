@@ -0,0 +1,121 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import pySpotify
+
+def applyPlan(testcase, current, plan):
+    # replays the plan the way the Web API applies each request
+    state = list(current)
+
+    for step in plan:
+        if step['op'] == 'remove':
+            positions = []
+            for track in step['tracks']:
+                for position in track['positions']:
+                    testcase.assertEqual(state[position], track['uri'])
+                    positions.append(position)
+
+            for position in sorted(positions, reverse=True):
+                del state[position]
+        elif step['op'] == 'move':
+            start = step['range_start']
+            length = step['range_length']
+            before = step['insert_before']
+
+            block = state[start:start + length]
+            testcase.assertEqual(block, step['uris'])
+
+            del state[start:start + length]
+            if before > start:
+                before -= length
+            state[before:before] = block
+        elif step['op'] == 'add':
+            testcase.assertLessEqual(step['position'], len(state))
+            state[step['position']:step['position']] = step['uris']
+        else:
+            testcase.fail('Unknown op {}'.format(step['op']))
+
+    return state
+
+def ops(plan, name):
+    return list(filter(lambda step: step['op'] == name, plan))
+
+class PlanPlaylistSyncTest(unittest.TestCase):
+    def assertPlan(self, current, desired, batchSize=100):
+        plan = pySpotify.planPlaylistSync(current, desired, batchSize=batchSize)
+        self.assertEqual(applyPlan(self, current, plan), desired)
+
+        return plan
+
+    def testUnchanged(self):
+        self.assertEqual(self.assertPlan(list('abcdef'), list('abcdef')), [])
+
+    def testReorderOnly(self):
+        # a reorder keeps every track, so nothing may be removed and added again
+        for desired in (list('fedcba'), list('bcdefa'), list('fabcde'), list('badcfe'), list('acbdfe')):
+            plan = self.assertPlan(list('abcdef'), desired)
+
+            self.assertEqual(ops(plan, 'remove'), [])
+            self.assertEqual(ops(plan, 'add'), [])
+
+    def testSingleMoveIsOneRequest(self):
+        current = list(map(str, range(50)))
+        desired = current[:10] + current[11:40] + [current[10]] + current[40:]
+
+        self.assertEqual(len(self.assertPlan(current, desired)), 1)
+
+    def testDuplicates(self):
+        self.assertPlan(list('abacada'), list('aaabcd'))
+        self.assertPlan(list('aaaa'), list('aa'))
+        self.assertPlan(list('abab'), list('baba'))
+        self.assertPlan(list('abc'), list('abcabc'))
+
+        # removing one copy of a repeated track removes exactly that position
+        plan = self.assertPlan(list('abcb'), list('abc'))
+        self.assertEqual(ops(plan, 'remove')[0]['tracks'], [{'uri': 'b', 'positions': [3]}])
+
+    def testMixedRemoveMoveAdd(self):
+        plan = self.assertPlan(list('abcdefgh'), list('xhbcaeyfz'))
+
+        self.assertTrue(all(ops(plan, name) for name in ('remove', 'move', 'add')))
+
+        # every removal batch is applied before any index-shifting move or add
+        names = list(map(lambda step: step['op'], plan))
+        self.assertEqual(names, sorted(names, key=['remove', 'move', 'add'].index))
+
+    def testBatches(self):
+        current = list(map(lambda i: 'spotify:track:{}'.format(i), range(250)))
+        desired = current[::2] + list(map(lambda i: 'spotify:track:new{}'.format(i), range(130)))
+
+        plan = self.assertPlan(current, desired, batchSize=100)
+
+        self.assertTrue(all(len(step['uris']) <= 100 for step in plan))
+        self.assertEqual(len(ops(plan, 'remove')), 2)
+        self.assertEqual(len(ops(plan, 'add')), 2)
+
+    def testRandomEdits(self):
+        rng = random.Random(0)
+
+        for _ in range(500):
+            # a small alphabet makes duplicates common
+            current = list(map(lambda _: rng.choice('abcdefghij'), range(rng.randint(0, 30))))
+            desired = list(current)
+
+            for _ in range(rng.randint(0, 6)):
+                edit = rng.choice(('remove', 'move', 'add'))
+
+                if edit == 'remove' and desired:
+                    del desired[rng.randrange(len(desired))]
+                elif edit == 'move' and desired:
+                    desired.insert(rng.randint(0, len(desired) - 1), desired.pop(rng.randrange(len(desired))))
+                elif edit == 'add':
+                    desired.insert(rng.randint(0, len(desired)), rng.choice('abcdefghijkl'))
+
+            self.assertPlan(current, desired, batchSize=rng.choice((1, 3, 100)))
+
+if __name__ == '__main__':
+    unittest.main()